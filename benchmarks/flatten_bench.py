@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Micro-benchmarks for ocarina.flatten against the per-row string formatting
+# the get commands used before. Run from the root of the repository with
+#   PYTHONPATH=. python benchmarks/flatten_bench.py [rows]
+import sys
+import timeit
+
+from ocarina import flatten
+
+def make_biosample(i):
+    return {
+        "metadata": {
+            "epi": {"cluster": "c%d" % (i % 10), "week": str(i % 52)},
+            "sample": {"type": "swab", "site": "nose", "pillar": "2"},
+            "lab": {"plate": "P%d" % (i % 96), "well": "A%d" % (i % 12)},
+        },
+        "metrics": {
+            "ct": {
+                "min": 20.0 + (i % 10),
+                "max": 30.0 + (i % 10),
+                "records": [{"ct_value": 21.0, "test_kit": "kit", "test_target": "ORF1ab"}] * 3,
+            },
+        },
+    }
+
+def make_dataview_row(i):
+    return {
+        "central_sample_id": "S%d" % i,
+        "adm1": "UK-ENG",
+        "biosample": {"collection_date": "2021-01-01", "received_date": None, "is_surveillance": True},
+        "library": {"library_name": "L%d" % (i % 100), "library_strategy": "AMPLICON"},
+        "pag": {"published_name": "PAG%d" % i, "is_suppressed": False},
+    }
+
+def format_meta(biosample):
+    flat = {}
+    for tag in biosample["metadata"]:
+        for name in biosample["metadata"][tag]:
+            flat["meta.%s.%s" % (tag, name)] = biosample["metadata"][tag][name]
+    for tag in biosample["metrics"]:
+        for name in biosample["metrics"][tag]:
+            if name == "records":
+                for record_i, record in enumerate(biosample["metrics"][tag][name]):
+                    for sub_name, sub_value in record.items():
+                        flat["metric.%s.%d.%s" % (tag, record_i+1, sub_name)] = sub_value
+            else:
+                flat["metric.%s.%s" % (tag, name)] = biosample["metrics"][tag][name]
+    return flat
+
+def flatten_meta(biosample):
+    flat = flatten.flatten_into(biosample["metadata"], {}, "meta.")
+    metric_prefix = flatten.prefix("metric.")
+    for tag in biosample["metrics"]:
+        flatten.flatten_metrics_into(biosample["metrics"][tag], flat, metric_prefix.child(tag))
+    return flat
+
+def format_dataview(row):
+    out_row = {}
+    for key in row.keys():
+        if isinstance(row[key], dict):
+            for subkey, value in row[key].items():
+                out_row["%s.%s" % (key, subkey)] = value
+        else:
+            out_row[key] = row[key]
+    return out_row
+
+def flatten_dataview(row):
+    return flatten.flatten_into(row, {}, depth=2)
+
+def bench(name, func, records, repeat=5):
+    best = min(timeit.repeat(lambda: [func(r) for r in records], number=1, repeat=repeat))
+    print("%-24s %8.1f ms %8.2f us/row" % (name, best * 1000, best * 1e6 / len(records)))
+    return best
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    biosamples = [make_biosample(i) for i in range(n)]
+    assert format_meta(biosamples[0]) == flatten_meta(biosamples[0])
+    print("sequencing meta/metrics, %d biosamples" % n)
+    bench("  % formatting", format_meta, biosamples)
+    bench("  ocarina.flatten", flatten_meta, biosamples)
+
+    rows = [make_dataview_row(i) for i in range(n)]
+    assert format_dataview(rows[0]) == flatten_dataview(rows[0])
+    print("dataview rows, %d rows" % n)
+    bench("  % formatting", format_dataview, rows)
+    bench("  ocarina.flatten", flatten_dataview, rows)
+
+if __name__ == "__main__":
+    main()
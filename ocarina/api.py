@@ -1,3 +1,7 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
 from . import util
 
 class OcarinaAPI:
@@ -12,14 +16,14 @@ class OcarinaAPI:
 
         return (status, return_payload)
 
-    def get_task(self, task_id):
+    def get_task(self, task_id, iter_path=None, stream=None):
         payload = {
             "task_id": task_id,
         }
         endpoint = "api.majora.task.get"
         if self.ocarina.stream:
             endpoint = "api.majora.task.stream"
-        j = util.emit(self.ocarina, self.endpoints[endpoint], payload, quiet=True)
+        j = util.emit(self.ocarina, self.endpoints[endpoint], payload, quiet=True, iter_path=iter_path, stream=stream, cache_key=task_id)
         return self.response_to_user(j, j)
 
     # NOTE samstudio8 2021-12-08: empty biosamples can now be tagged with key-value metadata
@@ -47,7 +51,8 @@ class OcarinaAPI:
             library_seq_protocol,
             library_layout_insert_length=None,
             library_layout_read_length=None,
-            metadata=None):
+            metadata=None,
+            quiet=False):
 
         #TODO Some sort of validation of Biosamples?
         if not metadata:
@@ -62,7 +67,7 @@ class OcarinaAPI:
             "library_seq_protocol": library_seq_protocol,
             "metadata": metadata,
         }
-        j = util.emit(self.ocarina, self.endpoints["api.artifact.library.add"], payload)
+        j = util.emit(self.ocarina, self.endpoints["api.artifact.library.add"], payload, quiet=quiet)
         return self.response_to_user(j, j)
 
     def put_sequencing(self,
@@ -77,7 +82,8 @@ class OcarinaAPI:
                         flowcell_type=None,
                         run_group=None,
                         sequencing_id=None,
-                        start_time=None):
+                        start_time=None,
+                        quiet=False):
 
         payload = {
             "library_name": library_name,
@@ -95,7 +101,7 @@ class OcarinaAPI:
                 "start_time": start_time,
             }],
         }
-        j = util.emit(self.ocarina, self.endpoints["api.process.sequencing.add"], payload)
+        j = util.emit(self.ocarina, self.endpoints["api.process.sequencing.add"], payload, quiet=quiet)
         return self.response_to_user(j, j)
 
 
@@ -131,3 +137,65 @@ class OcarinaAPI:
         }
         j = util.emit(self.ocarina, self.endpoints["api.v0.artifact.info"], payload)
         return self.response_to_user(j, j["info"])
+
+
+def _call_without_exit(f, *args, **kwargs):
+    # emit will sys.exit on a rejected request, which would take the whole event
+    # loop down with it, so return a failed response instead
+    try:
+        return f(*args, **kwargs)
+    except SystemExit:
+        return (False, None)
+
+class AsyncOcarinaAPI:
+    # Mirrors OcarinaAPI for asyncio callers. Requests still go through the
+    # blocking util.emit, but run on a fixed pool of threads that share the
+    # ocarina's pooled session, and the semaphore keeps any number of awaiting
+    # callers parked cheaply until one of those threads is free.
+    def __init__(self, ocarina, concurrency=None):
+        self.ocarina = ocarina
+        self.concurrency = concurrency # defaults to OCARINA_POOL_SIZE on first use
+        self._executor = None
+        self._semaphore = None
+
+    async def _call(self, f, *args, **kwargs):
+        if not self.concurrency:
+            self.concurrency = self.ocarina.config.get("OCARINA_POOL_SIZE", 10)
+        if not self._executor:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        if not self._semaphore:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(_call_without_exit, f, *args, **kwargs))
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # Wait for the pool to finish off the loop's thread
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    async def get_task(self, task_id, iter_path=None, stream=None):
+        return await self._call(self.ocarina.api.get_task, task_id, iter_path=iter_path, stream=stream)
+
+    async def put_force_linked_biosample(self, central_sample_id, sender_sample_id, metadata=None):
+        return await self._call(self.ocarina.api.put_force_linked_biosample, central_sample_id, sender_sample_id, metadata=metadata)
+
+    async def put_library(self, *args, **kwargs):
+        return await self._call(self.ocarina.api.put_library, *args, **kwargs)
+
+    async def put_sequencing(self, *args, **kwargs):
+        return await self._call(self.ocarina.api.put_sequencing, *args, **kwargs)
+
+    async def put_accession(self, *args, **kwargs):
+        return await self._call(self.ocarina.api.put_accession, *args, **kwargs)
+
+    async def get_artifact_info(self, query):
+        return await self._call(self.ocarina.api.get_artifact_info, query)
@@ -5,7 +5,10 @@ import csv
 import json
 import time
 import argparse
+import hashlib
+import tempfile
 import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 from rich import box
 from rich.console import Console
@@ -13,6 +16,10 @@ from rich.table import Table
 from rich import print as rich_print
 
 from . import util
+from . import codec
+from . import jsonstream
+from . import export
+from . import flatten
 from . import parsers
 from . import api
 from .version import __version__
@@ -101,6 +108,7 @@ ENDPOINTS = {
             "version": 2,
             "type": "POST",
             "scope": "majora2.temp_can_read_pags_via_api",
+            "idempotent": True,
         },
 
         "api.pag.accession.add": {
@@ -115,6 +123,7 @@ ENDPOINTS = {
             "version": 2,
             "type": "POST",
             "scope": "majora2.view_biosampleartifact",
+            "idempotent": True,
         },
 
         "api.process.sequencing.get": {
@@ -122,6 +131,7 @@ ENDPOINTS = {
             "version": 2,
             "type": "POST",
             "scope": "majora2.view_biosampleartifact", # can view biosample data (need a version without biosamples)
+            "idempotent": True,
         },
 
         "api.process.sequencing.get2": {
@@ -129,6 +139,7 @@ ENDPOINTS = {
             "version": 2,
             "type": "POST",
             "scope": "majora2.view_biosampleartifact", # can view biosample data (need a version without biosamples)
+            "idempotent": True,
         },
 
         "api.artifact.biosample.query.validity": {
@@ -136,6 +147,7 @@ ENDPOINTS = {
             "version": 2,
             "type": "POST",
             "scope": "majora2.view_biosampleartifact", # scopeless server side
+            "idempotent": True,
         },
 
         "api.majora.summary.get": {
@@ -143,6 +155,7 @@ ENDPOINTS = {
             "version": 2,
             "type": "POST",
             "scope": "", # scopeless server side
+            "idempotent": True,
         },
 
         "api.outbound.summary.get": {
@@ -150,6 +163,7 @@ ENDPOINTS = {
             "version": 2,
             "type": "POST",
             "scope": "", # scopeless server side
+            "idempotent": True,
         },
 
         "api.majora.task.get": {
@@ -157,6 +171,7 @@ ENDPOINTS = {
             "version": 2,
             "type": "POST",
             "scope": "", # scopeless server side
+            "idempotent": True,
         },
 
         "api.majora.task.stream": "/api/v2/majora/task/stream/",
@@ -198,10 +213,15 @@ class Ocarina():
         self.sudo_as = None
         self.stream = False
         self.interactive = False
+        self.http_session = None # pooled session shared by all emits
+        self.http_adapter = None
+        self.rate_limiter = None
+        self.task_cache = None
 
         # this is all terrible but we gotta get going
         self.api = api.OcarinaAPI(self)
         self.api.endpoints = ENDPOINTS 
+        self.async_api = api.AsyncOcarinaAPI(self)
 
 def cli():
 
@@ -274,6 +294,14 @@ def cli():
     biosample_parser.add_argument("--collection-pillar", type=int)
     biosample_parser.set_defaults(func=wrap_single_biosample_emit)
 
+    biosamples_parser = subparsers.add_parser("biosamples", parents=[put_parser], add_help=False,
+            help="add or update many biosamples from a TSV or CSV with a column for each `put biosample` field")
+    biosamples_parser.add_argument("--from-tsv", required=True, help="TSV (or .csv) of biosamples, columns are named for the `put biosample` flags and may include meta.<tag>.<name> and metric.<namespace>.<name>")
+    biosamples_parser.add_argument("--chunk-size", type=int, default=500, help="Most biosamples to send in one request [500]")
+    biosamples_parser.add_argument("--chunk-bytes", type=int, default=0, help="Most bytes of JSON to send in one request, 0 for no limit [0]")
+    biosamples_parser.add_argument("--threads", type=int, help="Number of requests to submit at once [OCARINA_POOL_SIZE]")
+    biosamples_parser.set_defaults(func=wrap_bulk_biosample_emit)
+
     library_parser = subparsers.add_parser("library", parents=[put_parser], add_help=False,
             help="add a sequencing library by providing fields via the CLI")
     lpg = library_parser.add_mutually_exclusive_group(required=True)
@@ -332,6 +360,8 @@ def cli():
     digitalresource_parser.add_argument("--full-path", action="store_true")
     digitalresource_parser.add_argument("--no-user", action="store_true")
     digitalresource_parser.add_argument("--artifact-uuid")
+    digitalresource_parser.add_argument("--digest", nargs='+', metavar="algorithm", choices=sorted([a for a in hashlib.algorithms_guaranteed if not a.startswith("shake_")]), default=[],
+            help="Also add these digests of the file (eg. sha256) as digest.<algorithm> metadata, made in the same pass as the MD5 current_hash")
     digitalresource_parser.set_defaults(func=wrap_digitalresource_emit)
 
 
@@ -378,6 +408,16 @@ def cli():
     publish_parser.set_defaults(func=wrap_publish_emit)
 
 
+    batch_parser = action_parser.add_parser("batch",
+            help="submit many biosample, library and sequencing records from a JSONL or TSV file")
+    batch_parser.add_argument("path", help="JSONL or TSV file with an action field for each record")
+    batch_parser.add_argument("--format", choices=["jsonl", "tsv", "csv"], help="Input format [guessed from extension]")
+    batch_parser.add_argument("--results", "-o", help="Per-record results TSV [default: stdout]", default="-")
+    batch_parser.add_argument("--threads", type=int, help="Number of records to submit at once [OCARINA_POOL_SIZE]")
+    batch_parser.add_argument("--sudo-as", required=False)
+    batch_parser.set_defaults(func=wrap_batch_emit)
+
+
     list_parser = action_parser.add_parser("list")
     list_parser.add_argument("path", help="node://absolute/path/to/artifact/or/group")
     list_parser.add_argument("--sep", default="/", required=False)
@@ -385,26 +425,43 @@ def cli():
     list_parser.set_defaults(func=wrap_list_mag)
 
 
-    get_parser = action_parser.add_parser("get")
-    get_parser.add_argument("--task-wait-attempts", help="Number of attempts to query a task from the task endpoint [10]", type=int, default=10)
-    get_parser.add_argument("--task-wait-minutes", help="Number of minutes to wait between task fetching attempts [1]", type=int, default=1)
-    get_parser.add_argument("--task-wait", help="Patiently wait for the result from the Majora task endpoint", action="store_true")
+    # Options for waiting on tasks, shared by get and get task
+    task_wait_parser = argparse.ArgumentParser(add_help=False)
+    task_wait_parser.add_argument("--task-wait-attempts", help="Wait for up to this many --task-wait-minutes for the task to finish, unless --task-wait-deadline is set [10]", type=int, default=10)
+    task_wait_parser.add_argument("--task-wait-minutes", help="Most number of minutes to wait between task fetching attempts [1]", type=int, default=1)
+    task_wait_parser.add_argument("--task-wait-initial", help="Number of seconds to wait before first fetching the task, doubling after each attempt up to --task-wait-minutes [2]", type=int, default=2)
+    task_wait_parser.add_argument("--task-wait-deadline", help="Give up waiting for the task after this many minutes [--task-wait-attempts * --task-wait-minutes]", type=int)
+    task_wait_parser.add_argument("--task-wait", help="Patiently wait for the result from the Majora task endpoint", action="store_true")
+
+    output_parser = argparse.ArgumentParser(add_help=False)
+    output_parser.add_argument("--output", "-o", help="Output location, compressed if it ends in .gz or .zst [default: stdout]", default="-")
+    output_parser.add_argument("--output-compression", choices=export.OUTPUT_COMPRESSION, default="auto", help="Compress the --output with gzip or zstd (requires zstandard), or not at all [auto]")
+
+    get_parser = action_parser.add_parser("get", parents=[task_wait_parser])
     get_parser.add_argument("--task-id", help="Request the result from the Majora task endpoint")
     get_parser.add_argument("--task-del", help="Destroy the task result if this command finishes successfully", action="store_true")
     get_subparsers = get_parser.add_subparsers(title="actions")
 
+    get_task_parser = get_subparsers.add_parser("task", parents=[task_wait_parser],
+            help="wait for the results of one or more Majora tasks and write each to a JSON file")
+    get_task_parser.add_argument("--task-id", help="Request the result of these tasks from the Majora task endpoint", nargs='+', required=True)
+    get_task_parser.add_argument("--task-del", help="Destroy each task result once it has been written", action="store_true")
+    get_task_parser.add_argument("--output-dir", help="Directory to write <task_id>.json results [default: .]", default=".")
+    get_task_parser.add_argument("--threads", type=int, help="Number of tasks to fetch at once [OCARINA_POOL_SIZE]")
+    get_task_parser.set_defaults(func=wrap_get_task)
+
     get_biosample_parser = get_subparsers.add_parser("biosample", parents=[get_parser], add_help=False,
             help="fetch a biosample")
     get_biosample_parser.add_argument("--central-sample-id", required=True)
     get_biosample_parser.set_defaults(func=wrap_get_biosample)
 
-    get_biosamplev_parser = get_subparsers.add_parser("biosample-validity", parents=[get_parser], add_help=False,
+    get_biosamplev_parser = get_subparsers.add_parser("biosample-validity", parents=[get_parser, output_parser], add_help=False,
             help="fetch biosamples status")
     get_biosamplev_parser.add_argument("--biosamples", nargs='+', required=True)
     get_biosamplev_parser.add_argument("--tsv", action="store_true")
     get_biosamplev_parser.set_defaults(func=wrap_get_biosamplev)
 
-    get_sequencing_parser = get_subparsers.add_parser("sequencing", parents=[get_parser], add_help=False,
+    get_sequencing_parser = get_subparsers.add_parser("sequencing", parents=[get_parser, output_parser], add_help=False,
             help="fetch a sequencing run")
     get_sequencing_parser.add_argument("--run-name", required=True, nargs='+')
     get_sequencing_parser.add_argument("--tsv", action="store_true")
@@ -413,7 +470,7 @@ def cli():
     get_sequencing_parser.set_defaults(func=wrap_get_sequencing)
 
 
-    get_pag_parser = get_subparsers.add_parser("pag", parents=[get_parser], add_help=False,
+    get_pag_parser = get_subparsers.add_parser("pag", parents=[get_parser, output_parser], add_help=False,
             help="Get all PAGs that have passed a QC test")
 
     get_pag_parser.add_argument("--test-name", required=True)
@@ -455,12 +512,12 @@ def cli():
     get_osummary_parser.set_defaults(func=wrap_get_outbound_summary)
 
 
-    get_mdv_parser = get_subparsers.add_parser("dataview", parents=[get_parser], add_help=False,
+    get_mdv_parser = get_subparsers.add_parser("dataview", parents=[get_parser, output_parser], add_help=False,
             help="Get data through a data view")
     get_mdv_parser.add_argument("--mdv", required=True, help="Code name of data view")
-    get_mdv_parser.add_argument("--output", "-o", help="Output location [default: stdout]", default="-")
     get_mdv_parser.add_argument("--output-table", action="store_true")
     get_mdv_parser.add_argument("--output-table-delimiter", default='\t')
+    get_mdv_parser.add_argument("--output-table-format", choices=export.TABLE_FORMATS, default="delimited", help="Write the --output-table as delimited text, an Arrow IPC file or Parquet (requires pyarrow) [delimited]")
     get_mdv_parser.set_defaults(func=wrap_get_dataview)
 
 
@@ -627,6 +684,138 @@ def wrap_single_biosample_emit(ocarina, args, metadata={}, metrics={}):
         ]}
         util.emit(ocarina, ENDPOINTS["api.artifact.biosample.add"], payload)
 
+BIOSAMPLE_FIELDS = [
+    "adm1",
+    "central_sample_id",
+    "is_surveillance",
+    "collection_date",
+    "received_date",
+    "source_age",
+    "source_sex",
+    "adm2",
+    "adm2_private",
+    "biosample_source_id",
+    "root_biosample_source_id",
+    "collecting_org",
+    "root_sample_id",
+    "sample_type_collected",
+    "sample_type_received",
+    "sender_sample_id",
+    "swab_site",
+    "collection_pillar",
+]
+
+def _read_biosample_table(path, partial=False, metadata={}, metrics={}):
+    # Read biosamples from a table with the same columns as the put biosample
+    # flags (eg. central_sample_id, central-sample-id or --central-sample-id)
+    biosamples = []
+    problems = []
+    for i, row in enumerate(_read_table(path)):
+        biosample = {}
+        for key, value in row.items():
+            if key is None:
+                problems.append("row %d has more cells than the header" % (i+1))
+                continue
+            if not (key.startswith("meta.") or key.startswith("metric.")):
+                key = key.lstrip('-').replace('-', '_')
+                if key == "local_sample_id":
+                    key = "sender_sample_id"
+                if key not in BIOSAMPLE_FIELDS:
+                    problems.append("unknown biosample field '%s'" % key)
+                    continue
+            biosample[key] = value
+        biosample = _fold_table_metadata(biosample)
+
+        # --metadata and --metric apply to every row, unless the row says otherwise
+        for target, defaults in [(biosample["metadata"], metadata), (biosample["metrics"], metrics)]:
+            for namespace, values in defaults.items():
+                target[namespace] = dict(values, **target.get(namespace, {}))
+
+        if biosample.get("collection_pillar") not in [None, "_null_"]:
+            try:
+                biosample["collection_pillar"] = int(biosample["collection_pillar"])
+            except ValueError:
+                problems.append("row %d has a collection_pillar that is not a number" % (i+1))
+
+        if not biosample.get("central_sample_id"):
+            problems.append("row %d is missing central_sample_id" % (i+1))
+        elif not partial:
+            missing = [k for k in ["adm1", "is_surveillance"] if not biosample.get(k)]
+            if not biosample.get("collection_date") and not biosample.get("received_date"):
+                missing.append("collection_date or received_date")
+            if missing:
+                problems.append("row %d (%s) is missing %s, use --partial to update existing biosamples" % (i+1, biosample["central_sample_id"], ", ".join(missing)))
+
+        if partial:
+            biosamples.append(prune_null(biosample))
+        else:
+            biosamples.append({k: biosample.get(k) for k in BIOSAMPLE_FIELDS + ["metadata", "metrics"]})
+
+    # Report each problem once, unknown columns would otherwise repeat for every row
+    return biosamples, list(dict.fromkeys(problems))
+
+def _chunk_biosamples(biosamples, chunk_size=0, chunk_bytes=0):
+    # Pack biosamples into lists of at most chunk_size biosamples and roughly
+    # chunk_bytes of JSON, a biosample that is too big on its own is sent alone
+    chunk = []
+    chunk_len = 0
+    for biosample in biosamples:
+        size = len(codec.dumps(biosample)) + 1 if chunk_bytes else 0
+        if chunk and ((chunk_size and len(chunk) >= chunk_size) or (chunk_bytes and chunk_len + size > chunk_bytes)):
+            yield chunk
+            chunk = []
+            chunk_len = 0
+        chunk.append(biosample)
+        chunk_len += size
+    if chunk:
+        yield chunk
+
+def _run_biosample_chunk(ocarina, endpoint, chunk):
+    # As _run_batch_record, keep going if one chunk is rejected
+    return util.catch_exit(util.emit, ocarina, endpoint, {"biosamples": chunk}, quiet=True)
+
+def wrap_bulk_biosample_emit(ocarina, args, metadata={}, metrics={}):
+    biosamples, problems = _read_biosample_table(args.from_tsv, partial=args.partial, metadata=metadata, metrics=metrics)
+    if problems:
+        for problem in problems:
+            sys.stderr.write("[FAIL] %s\n" % problem)
+        sys.exit(65) #EX_DATAERR
+    if not biosamples:
+        sys.stderr.write("No biosamples found in %s.\n" % args.from_tsv)
+        sys.exit(66) #EX_NOINPUT
+
+    if args.partial:
+        endpoint = ENDPOINTS["api.artifact.biosample.update"]
+    else:
+        endpoint = ENDPOINTS["api.artifact.biosample.add"]
+
+    chunks = list(_chunk_biosamples(biosamples, chunk_size=max(0, args.chunk_size), chunk_bytes=max(0, args.chunk_bytes)))
+    if ocarina.oauth:
+        util.start_oauth_refresher(ocarina.config)
+    threads = args.threads if args.threads else ocarina.config.get("OCARINA_POOL_SIZE", 10)
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        futures = {pool.submit(_run_biosample_chunk, ocarina, endpoint, chunk): i for i, chunk in enumerate(chunks)}
+        for future in as_completed(futures):
+            i = futures[future]
+            code, j, message = future.result()
+
+            errors = j.get("errors", 0) if j else 0
+            warnings = j.get("warnings", 0) if j else 0
+            ok = code == 0 and not errors
+            if not ok:
+                failed += 1
+            chunk = chunks[i]
+            sys.stderr.write("[%s] chunk %d of %d, %d biosamples (%s to %s), exit %d, %d errors, %d warnings%s\n" % (
+                "OK" if ok else "FAIL", i+1, len(chunks), len(chunk),
+                chunk[0].get("central_sample_id"), chunk[-1].get("central_sample_id"),
+                code, errors, warnings, (", " + message) if message and message != str(code) else ""))
+
+    sys.stderr.write("[BIOSAMPLES] %d biosamples submitted in %d requests, %d requests failed\n" % (len(biosamples), len(chunks), failed))
+    if failed:
+        sys.exit(1) #EX_GENERAL
+
 def wrap_get_artifact_info(ocarina, args, metadata={}, metrics={}):
     success, json = ocarina.api.get_artifact_info(
             args.query
@@ -673,13 +862,14 @@ def wrap_get_biosamplev(ocarina, args, metadata={}, metrics={}):
 
     if args.tsv:
         if len(j["result"]) > 0:
-            print("sample_id\texists\thas_metadata")
-            for sample_id, sample_d in j["result"].items():
-                print("\t".join([str(x) for x in [
-                    sample_id,
-                    1 if sample_d["exists"] else 0,
-                    1 if sample_d["has_metadata"] else 0,
-                ]]))
+            with export.OutputSink(args.output, args.output_compression) as out_f:
+                out_f.write("sample_id\texists\thas_metadata\n")
+                for sample_id, sample_d in j["result"].items():
+                    out_f.write("\t".join([str(x) for x in [
+                        sample_id,
+                        1 if sample_d["exists"] else 0,
+                        1 if sample_d["has_metadata"] else 0,
+                    ]]) + "\n")
 
 def wrap_get_biosample(ocarina, args, metadata={}, metrics={}):
     v_args = vars(args)
@@ -739,9 +929,95 @@ def wrap_get_summary(ocarina, args, metadata={}, metrics={}):
                     0 if group["surveillance_dom"] == 0 else group["surveillance_num"]/group["surveillance_dom"] * 100,
                 ))
 
+# A poll that fails with one of these (unavailable, a dropped connection or
+# something unexpected, and temporary failures) may work if it is tried again,
+# anything else (eg. 77 for a bad request or no permission) will not
+RETRY_POLL_CODES = [69, 70, 75]
+
+def _poll_task(ocarina, task_id):
+    # As _run_batch_record, a bad response should not stop the other tasks.
+    # Returns the response, the task state, why the poll failed (if it did) and
+    # whether it is worth polling again
+    code, ret, message = util.catch_exit(ocarina.api.get_task, task_id)
+    if code:
+        message = "poll failed with %s" % util.exit_message(code, message)
+        sys.stderr.write("[TASK] %s %s\n" % (task_id, message))
+        return None, "UNKNOWN", message, code in RETRY_POLL_CODES
+    status, j = ret
+    state = j.get("task", {}).get("state", "UNKNOWN")
+    return j, state, "", state == "PENDING"
+
+def _write_task_result(ocarina, args, task_id, j):
+    path = os.path.join(args.output_dir, "%s.json" % task_id)
+    with open(path, 'wb') as out_f:
+        out_f.write(codec.dumps(j))
+    if args.task_del:
+        util.emit(ocarina, ENDPOINTS["api.majora.task.delete"], {"task_id": task_id})
+    return path
+
 def wrap_get_task(ocarina, args, metadata={}, metrics={}):
     v_args = vars(args)
-    status, j = ocarina.api.get_task(v_args["task_id"])
+    task_ids = list(dict.fromkeys(args.task_id))
+    threads = args.threads if args.threads else ocarina.config.get("OCARINA_POOL_SIZE", 10)
+    if args.task_wait and ocarina.oauth:
+        util.start_oauth_refresher(ocarina.config)
+
+    # Every task gets its own poll schedule, the earliest poll due goes next
+    tasks = {task_id: {"state": "PENDING", "attempts": 0, "path": "", "message": ""} for task_id in task_ids}
+    schedules = {}
+    due = []
+    for task_id in task_ids:
+        if args.task_wait:
+            schedules[task_id] = util.task_poll_schedule(*_task_wait_schedule(v_args))
+            delay = next(schedules[task_id], None)
+        else:
+            delay = 0
+        if delay is not None:
+            due.append((time.time() + delay, task_id))
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        running = {}
+        while due or running:
+            now = time.time()
+            due.sort(reverse=True)
+            while due and due[-1][0] <= now:
+                poll_at, task_id = due.pop()
+                tasks[task_id]["attempts"] += 1
+                running[pool.submit(_poll_task, ocarina, task_id)] = task_id
+
+            timeout = max(0, due[-1][0] - now) if due else None
+            if not running:
+                time.sleep(timeout)
+                continue
+            done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                task_id = running.pop(future)
+                j, state, message, retry = future.result()
+                tasks[task_id]["state"] = state
+                tasks[task_id]["message"] = message
+                if state == "SUCCESS":
+                    tasks[task_id]["path"] = _write_task_result(ocarina, args, task_id, j)
+                    sys.stderr.write("[TASK] %s SUCCESS, written to %s\n" % (task_id, tasks[task_id]["path"]))
+                elif retry and task_id in schedules:
+                    # A poll that failed for a reason that may pass is tried
+                    # again on the same schedule, the task is only UNKNOWN if
+                    # the schedule runs out
+                    delay = next(schedules[task_id], None)
+                    if delay is not None:
+                        due.append((time.time() + delay, task_id))
+
+    print("\t".join(["task_id", "state", "attempts", "exit_code", "path", "message"]))
+    failed = 0
+    for task_id in task_ids:
+        task = tasks[task_id]
+        code = _task_exit_code(task["state"])
+        if code:
+            failed += 1
+        print("\t".join([task_id, task["state"], str(task["attempts"]), str(code), task["path"], task["message"]]))
+
+    sys.stderr.write("[TASK] %d of %d tasks finished successfully\n" % (len(task_ids) - failed, len(task_ids)))
+    if failed:
+        sys.exit(1) #EX_GENERAL
 
 def wrap_del_task(ocarina, args, metadata={}, metrics={}):
     v_args = vars(args)
@@ -753,10 +1029,21 @@ def wrap_oauth_refresh(ocarina, args, metadata={}, metrics={}):
         if ocarina.oauth_token:
             print("Token with scope '%s' refreshed successfully" % " ".join(args.scopes))
     else:
-        for scope in util.oauth_load_tokens(ocarina.config["MAJORA_TOKENS_FILE"]):
-            ocarina.oauth_session, ocarina.oauth_token = util.handle_oauth(ocarina.config, scope, force_refresh=True)
-            if ocarina.oauth_token:
-                print("Token with scope '%s' refreshed successfully" % scope)
+        start_time = time.time()
+        results = util.oauth_refresh_all(ocarina.config, threads=ocarina.config.get("OCARINA_POOL_SIZE", 10))
+        for scope, token, seconds, error in results:
+            if token:
+                print("Token with scope '%s' refreshed successfully (%.2fs)" % (scope, seconds))
+            else:
+                sys.stderr.write("[WARN] Token with scope '%s' could not be refreshed (%.2fs): %s\n" % (scope, seconds, error))
+        sys.stderr.write("[OAUTH] Refreshed %d of %d scopes in %.2fs\n" % (len([r for r in results if r[1]]), len(results), time.time() - start_time))
+
+        # Give anything that could not be refreshed another go the old fashioned way
+        for scope, token, seconds, error in results:
+            if not token:
+                ocarina.oauth_session, ocarina.oauth_token = util.handle_oauth(ocarina.config, scope, force_refresh=True)
+                if ocarina.oauth_token:
+                    print("Token with scope '%s' refreshed successfully" % scope)
 
 # TODO Could be merged into wrap_oauth_refresh
 def wrap_oauth_authorise(ocarina, args, metadata={}, metrics={}):
@@ -779,61 +1066,66 @@ def wrap_get_dataview(ocarina, args, metadata={}, metrics={}):
     my_args = {}
     my_args["params"] = { "mdv": args.mdv }
 
-    if args.output == "-":
-        out_f = sys.stdout
-    elif args.output:
-        out_f = open(args.output, 'w')
-
     if not args.task_id:
         j = util.emit(ocarina, ENDPOINTS["api.v3.majora.mdv.get"], my_args)
     else:
         j = {}
 
-    status, j =_wait_for_task(ocarina, v_args, j, task_wait=args.task_wait)
+    # With --stream (or a spooled response) leave the data on the response so it
+    # can be copied to the output as is, or written to the table one row at a time
+    status, j =_wait_for_task(ocarina, v_args, j, task_wait=args.task_wait, iter_path=("data",))
 
     json_data = j.get("data")
     if json_data:
-        # try to flatten the non-object keys
         if args.output_table:
-            keys = set([])
-            # collect all possible keys naively
+            # try to flatten the non-object keys
+            spill = export.TableSpill()
             for row in json_data:
-                for key in row.keys():
-                    # Dip in one level
-                    if isinstance(row[key], dict):
-                        for subkey, value in row[key].items():
-                            mkey = "%s.%s" % (key, subkey)
-                            keys.add(mkey)
-                    else:
-                        keys.add(key)
-
-            # iterate and dump
-            csv_w = csv.DictWriter(out_f, fieldnames=keys, delimiter=args.output_table_delimiter)
-            csv_w.writeheader()
-
-            for row in json_data:
-                out_row = {}
-                for key in row.keys():
-                    if isinstance(row[key], dict):
-                        for subkey, value in row[key].items():
-                            mkey = "%s.%s" % (key, subkey)
-                            out_row[mkey] = value
-                    else:
-                        out_row[key] = row[key]
-
-                csv_w.writerow(out_row)
+                # Dip in one level
+                spill.add(flatten.flatten_into(row, {}, depth=2))
+
+            # Columns are in the order they first appear so the schema is the
+            # same every time for the same data
+            if args.output_table_format == "delimited":
+                with export.OutputSink(args.output, args.output_compression) as out_f:
+                    export.write_delimited(spill, out_f, delimiter=args.output_table_delimiter)
+            else:
+                with export.OutputSink(args.output, args.output_compression, binary=True) as out_f:
+                    export.write_arrow(spill, out_f, fmt=args.output_table_format)
+            spill.close()
         else:
-            # Just dump to JSON to file
-            json.dump(json_data, out_f)
+            with export.OutputSink(args.output, args.output_compression, binary=True) as out_f:
+                if isinstance(json_data, jsonstream.JsonPathStream):
+                    # Copy the raw JSON bytes from the response without decoding them
+                    json_data.copy_to(out_f)
+                else:
+                    # Just dump to JSON to file
+                    out_f.write(codec.dumps(json_data))
     else:
         sys.stderr.write("No data returned.\n")
         sys.exit(66) #EX_NOINPUT
+    _check_streamed_task(j, ("data",))
 
-    if out_f and args.output != "-":
-        out_f.close()
 
+def _has_result(j):
+    # A streamed result will not have seen the count yet if it comes after the result
+    return "get" in j and ("count" in j["get"] or "result" in j["get"])
+
+def _result_items(result):
+    # Results are a dict when decoded in full, or a JsonPathStream of pairs when streamed
+    if isinstance(result, dict):
+        return result.items()
+    return result
 
-def _wait_for_task(ocarina, v_args, j, task_wait=True):
+def _task_wait_schedule(v_args):
+    # Return the initial delay, longest delay and deadline (in seconds) for polling a task
+    ceiling = 60 * v_args.get("task_wait_minutes", 1)
+    deadline = v_args.get("task_wait_deadline")
+    if deadline is None:
+        deadline = v_args.get("task_wait_attempts", 10) * v_args.get("task_wait_minutes", 1)
+    return v_args.get("task_wait_initial", 2), ceiling, 60 * deadline
+
+def _wait_for_task(ocarina, v_args, j, task_wait=True, iter_path=None, stream=None):
     #TODO sam why
     if not v_args["task_id"]:
         try:
@@ -846,28 +1138,192 @@ def _wait_for_task(ocarina, v_args, j, task_wait=True):
     state = "PENDING"
     attempt = 0
     if task_wait:
-        while state == "PENDING" and attempt < v_args["task_wait_attempts"]:
+        if ocarina.oauth:
+            # Don't let the token expire while we are sleeping between polls
+            util.start_oauth_refresher(ocarina.config)
+        for delay in util.task_poll_schedule(*_task_wait_schedule(v_args)):
             attempt += 1
-            sys.stderr.write("[WAIT] Giving Majora a minute to finish task %s (%d)...\n" % (v_args["task_id"], attempt))
-            time.sleep(60 * v_args["task_wait_minutes"])
-            status, j = ocarina.api.get_task(v_args["task_id"])
-            state = j.get("task", {}).get("state", "UNKNOWN")
+            sys.stderr.write("[WAIT] Giving Majora %ds to finish task %s (%d)...\n" % (delay, v_args["task_id"], attempt))
+            time.sleep(delay)
+            status, j = ocarina.api.get_task(v_args["task_id"], iter_path=iter_path, stream=stream)
+            state = _task_state(j, iter_path)
+            if state != "PENDING":
+                break
         sys.stderr.write("[WAIT] Finished waiting with status %s (%d)...\n" % (state, attempt))
     else:
-        status, j = ocarina.api.get_task(v_args["task_id"])
-        state = j.get("task", {}).get("state", "UNKNOWN")
+        status, j = ocarina.api.get_task(v_args["task_id"], iter_path=iter_path, stream=stream)
+        state = _task_state(j, iter_path)
 
-    if state == "SUCCESS":
+    if state == "SUCCESS" or state == "STREAMED":
+        # A STREAMED task is checked by _check_streamed_task once it has been read
         return status, j
+    sys.exit(_task_exit_code(state))
+
+def _pending_stream(j, iter_path):
+    # Return the JsonPathStream at iter_path if it has not been consumed yet
+    value = j
+    for key in iter_path or ():
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    if isinstance(value, jsonstream.JsonPathStream) and not value.consumed:
+        return value
+    return None
+
+def _task_state(j, iter_path=None):
+    # Keys that come after iter_path are only decoded from a streamed response
+    # once the stream has been consumed, so if the result is there but the task
+    # is not (yet) the state is decided after it has been read
+    if "task" not in j and _pending_stream(j, iter_path):
+        return "STREAMED"
+    return j.get("task", {}).get("state", "UNKNOWN")
+
+def _check_streamed_task(j, iter_path):
+    # Read the rest of a streamed response and exit as _wait_for_task would
+    # have done if the task turns out not to have succeeded
+    stream = _pending_stream(j, iter_path)
+    if stream:
+        stream.skip()
+    state = j.get("task", {}).get("state", "UNKNOWN")
+    if state != "SUCCESS":
+        sys.stderr.write("[WAIT] Task finished with status %s\n" % state)
+        sys.exit(_task_exit_code(state))
+
+def _task_exit_code(state):
+    if state == "SUCCESS":
+        return 0
     elif state == "FAILED":
-        sys.exit(69) # EX_UNAVAILABLE
+        return 69 # EX_UNAVAILABLE
     elif state == "PENDING":
         # Not sure what the best error code is here, it's basically a timeout
         # But so long as we distinguish from 66 EX_NOINPUT this is fine
-        sys.exit(65) # EX_DATAERR
+        return 65 # EX_DATAERR
     else:
-        sys.exit(70) # EX_SOFTWARE
+        return 70 # EX_SOFTWARE
+
+
+def _compile_ofields(ofields):
+    # Work out which flattened PAG keys the --ofield columns refer to, so only
+    # those keys need to be pulled out of each PAG, and parse templates up front
+    columns = []
+    needed = set([])
+    for field, as_, default in ofields:
+        if field[0] == '~':
+            placeholders = [(m, m[1:-1]) for m in re.findall("{[\w\.]+}", field)]
+            needed.update([mkey for m, mkey in placeholders])
+            columns.append((as_, placeholders, field[1:], default))
+        #elif fields[0] == ':'
+        #    v = field[1:]
+        #    for vs in [re.findall(v, k) for k in metadata]:
+        #        pass
+        else:
+            needed.add(field)
+            columns.append((as_, field, None, default))
+
+    # Every dotted prefix of a needed key (with its trailing dot), to skip whole
+    # namespaces of a PAG
+    prefixes = set([])
+    for key in needed:
+        parts = key.split('.')
+        for i in range(1, len(parts)):
+            prefixes.add('.'.join(parts[:i]) + '.')
+
+    # Rows are written as lists in column order. Where two columns share a name
+    # both take the value of the last, as they always did when rows were dicts.
+    last = {as_: i for i, (as_, key, template, default) in enumerate(columns)}
+    sources = [last[as_] for as_, key, template, default in columns]
+    if sources == list(range(len(columns))):
+        sources = None
+
+    return {
+        "columns": columns,
+        "needed": needed,
+        "prefixes": prefixes,
+        "sources": sources,
+    }
 
+def _project_pag(pag, plan):
+    # Flatten the PAG to unique distinguished objects, as wrap_get_qc always has,
+    # but only for keys that are in the plan. Keys seen on more than one artifact
+    # are dropped (each repeat toggles the key) so every occurrence of a needed
+    # key is still visited in order.
+    needed = plan["needed"]
+    prefixes = plan["prefixes"]
+
+    metadata = {k:pag[k] for k in needed if k in pag and type(pag[k]) != dict and type(pag[k]) != list}
+    if "accessions" in pag and "accession." in prefixes:
+        for service in pag["accessions"]:
+            key_prefix = flatten.prefix("accession.").child(service.lower())
+            for mkey, mvalue in pag["accessions"][service].items():
+                if mkey == "service":
+                    continue
+                mkey = key_prefix[mkey]
+                if mkey in needed:
+                    metadata[mkey] = mvalue
+    if "qc_reports" in pag and "qc." in prefixes:
+        key_prefix = flatten.prefix("qc.")
+        for test, result in pag["qc_reports"].items():
+            mkey = key_prefix[test]
+            if mkey in needed:
+                metadata[mkey] = result
+
+    for artifact_g in pag["artifacts"]:
+        for artifact in pag["artifacts"][artifact_g]:
+            current_kind = artifact.get("current_kind", "") # TODO euch
+            kind_prefix = flatten.prefix().child(current_kind) if current_kind else flatten.prefix()
+            for k, v in artifact.items():
+
+                if k == "metadata":
+                    for namespace in artifact["metadata"]:
+                        key_prefix = flatten.prefix().child(namespace)
+                        if key_prefix.prefix not in prefixes:
+                            continue
+                        for mkey, mvalue in flatten.flatten(artifact["metadata"][namespace], key_prefix, depth=1):
+                            if mkey not in needed:
+                                continue
+                            if mkey not in metadata:
+                                metadata[mkey] = mvalue
+                            else:
+                                del metadata[mkey]
+                elif k == "metrics":
+                    for namespace in artifact["metrics"]:
+                        key_prefix = flatten.prefix("metric.").child(namespace)
+                        if key_prefix.prefix in prefixes:
+                            for mkey, mvalue, is_record in flatten.flatten_metrics(artifact["metrics"][namespace], key_prefix):
+                                if mkey not in needed:
+                                    continue
+                                if is_record:
+                                    metadata[mkey] = mvalue
+                                elif mkey not in metadata:
+                                    metadata[mkey] = mvalue
+                                else:
+                                    del metadata[mkey]
+                        # records is also toggled under its own name (as it always has been)
+                        if "records" in needed and "records" in artifact["metrics"][namespace]:
+                            if "records" not in metadata:
+                                metadata["records"] = artifact["metrics"][namespace]["records"]
+                            else:
+                                del metadata["records"]
+                elif k.startswith("supplement_"):
+                    key_prefix = flatten.prefix("supplement.").child(k.split('_')[1])
+                    if key_prefix.prefix not in prefixes:
+                        continue
+                    for mkey, mvalue in flatten.flatten(artifact[k], key_prefix, depth=1):
+                        if mkey not in needed:
+                            continue
+                        if mkey not in metadata:
+                            metadata[mkey] = mvalue
+                        else:
+                            del metadata[mkey]
+                else:
+                    k = kind_prefix[k]
+                    if k not in needed:
+                        continue
+                    if k not in metadata and type(v) != dict and type(v) != list:
+                        metadata[k] = v
+                    elif k in metadata:
+                        del metadata[k] # unique stuff only for now
+    return metadata
 
 def wrap_get_qc(ocarina, args, metadata={}, metrics={}):
     v_args = vars(args)
@@ -877,135 +1333,83 @@ def wrap_get_qc(ocarina, args, metadata={}, metrics={}):
     else:
         j = util.emit(ocarina, ENDPOINTS["api.pag.qc.get"], v_args)
 
-    status, j =_wait_for_task(ocarina, v_args, j, task_wait=args.task_wait)
+    status, j =_wait_for_task(ocarina, v_args, j, task_wait=args.task_wait, iter_path=("get", "result"))
 
     if args.mode.lower() == "pagfiles":
-        if "get" not in j or "count" not in j["get"]:
+        if not _has_result(j):
             # Bad reply
             sys.exit(69) #EX_UNAVAILABLE
-        if j["get"]["count"] >= 1:
-
-            if args.output_header:
-                print("\t".join([
-                    "pag_name",
-                    "file_type",
-                    "file_path",
-                    "file_hash",
-                    "file_size",
-                    "pag_suppressed",
-                    "pag_basic_qc",
-                    "published_date",
-                ]))
-            for fdat in j["get"]["result"]:
-                #pag, kind, path, fhash, fsize, pag_supp, pag_qc, published_date = fdat
-                # 0    1    2     3      4      5         6       7
-                fdat[6] = "PASS" if fdat[6] else "FAIL"
-                fdat[5] = "SUPPRESSED" if fdat[5] else "VALID" # wtf was i thinking this is gross
-
-                # Fix that pesky JSON datetime
-                fdat[7] = fdat[7].split('T')[0] # quite cheeky but just chopping off the time part of the JSON datetime
-
-                print("\t".join([ str(x) for x in fdat[:8] ])) # cut at col 8 to stop new cols breaking older versions
+        if j["get"].get("count", 1) >= 1:
+
+            with export.OutputSink(args.output, args.output_compression) as out_f:
+                if args.output_header:
+                    out_f.write("\t".join([
+                        "pag_name",
+                        "file_type",
+                        "file_path",
+                        "file_hash",
+                        "file_size",
+                        "pag_suppressed",
+                        "pag_basic_qc",
+                        "published_date",
+                    ]) + "\n")
+                for fdat in j["get"]["result"]:
+                    #pag, kind, path, fhash, fsize, pag_supp, pag_qc, published_date = fdat
+                    # 0    1    2     3      4      5         6       7
+                    fdat[6] = "PASS" if fdat[6] else "FAIL"
+                    fdat[5] = "SUPPRESSED" if fdat[5] else "VALID" # wtf was i thinking this is gross
+
+                    # Fix that pesky JSON datetime
+                    fdat[7] = fdat[7].split('T')[0] # quite cheeky but just chopping off the time part of the JSON datetime
+
+                    out_f.write("\t".join([ str(x) for x in fdat[:8] ]) + "\n") # cut at col 8 to stop new cols breaking older versions
 
     elif args.ofield:
-        csv_w = csv.DictWriter(sys.stdout, fieldnames=[f[1] for f in args.ofield], delimiter=args.odelimiter)
-        csv_w.writeheader()
-        skipped = 0
-        if "get" not in j or "count" not in j["get"]:
-            # Bad reply
-            sys.exit(69) #EX_UNAVAILABLE
-        if j["get"]["count"] >= 1:
-            for pag in j["get"]["result"]:
-                # Flatten the PAG to unique distinguished objects
-                pag = pag["pag"]
-                include = True
-                if args.ffield_true:
-                    for field in args.ffield_true:
-                        if field[0] in pag:
-                            if not pag[field[0]]:
-                                include = False
-                        else:
-                            pass
-                if not include:
-                    skipped += 1
-                    continue
-
-                metadata = {k:v for k,v in pag.items() if type(v) != dict and type(v) != list}
-                if "accessions" in pag:
-                    for service in pag["accessions"]:
-                        for mkey, mvalue in pag["accessions"][service].items():
-                            if mkey == "service":
-                                continue
-                            mkey = "accession.%s.%s" % (service.lower(), mkey)
-                            metadata[mkey] = mvalue
-                if "qc_reports" in pag:
-                    for test, result in pag["qc_reports"].items():
-                        metadata["qc.%s" % test] = result
-
-                for artifact_g in pag["artifacts"]:
-                    for artifact in pag["artifacts"][artifact_g]:
-                        current_kind = artifact.get("current_kind", "") # TODO euch
-                        for k, v in artifact.items():
-
-                            if k == "metadata":
-                                for namespace in artifact["metadata"]:
-                                    for mkey, mvalue in artifact["metadata"][namespace].items():
-                                        mkey = "%s.%s" % (namespace, mkey)
-                                        if mkey not in metadata:
-                                            metadata[mkey] = mvalue
-                                        else:
-                                            del metadata[mkey]
-                            elif k == "metrics":
-                                for namespace in artifact["metrics"]:
-                                    for mkey, mvalue in artifact["metrics"][namespace].items():
-                                        if mkey == "records":
-                                            for record_i, record in enumerate(mvalue):
-                                                for sub_name, sub_value in record.items():
-                                                    skey = "metric.%s.%d.%s" % (namespace, record_i+1, sub_name)
-                                                    metadata[skey] = sub_value
-                                        else:
-                                            mkey = "metric.%s.%s" % (namespace, mkey)
-
-                                        if mkey not in metadata:
-                                            metadata[mkey] = mvalue
-                                        else:
-                                            del metadata[mkey]
-                            elif k.startswith("supplement_"):
-                                for mkey, mvalue in artifact[k].items():
-                                    mkey = "supplement.%s.%s" % (k.split('_')[1], mkey)
-                                    if mkey not in metadata:
-                                        metadata[mkey] = mvalue
-                                    else:
-                                        del metadata[mkey]
+        with export.OutputSink(args.output, args.output_compression) as out_f:
+            csv_w = csv.writer(out_f, delimiter=args.odelimiter)
+            csv_w.writerow([f[1] for f in args.ofield])
+            plan = _compile_ofields(args.ofield)
+            sources = plan["sources"]
+            skipped = 0
+            if not _has_result(j):
+                # Bad reply
+                sys.exit(69) #EX_UNAVAILABLE
+            if j["get"].get("count", 1) >= 1:
+                for pag in j["get"]["result"]:
+                    # Flatten the PAG to unique distinguished objects
+                    pag = pag["pag"]
+                    include = True
+                    if args.ffield_true:
+                        for field in args.ffield_true:
+                            if field[0] in pag:
+                                if not pag[field[0]]:
+                                    include = False
                             else:
-                                if current_kind:
-                                    k = "%s.%s" % (current_kind, k)
-                                if k not in metadata and type(v) != dict and type(v) != list:
-                                    metadata[k] = v
-                                elif k in metadata:
-                                    del metadata[k] # unique stuff only for now
-
-
-                row = {}
-                for ofield in args.ofield:
-                    field, as_, default = ofield
-                    if field[0] == '~':
-                        v = field[1:]
-                        for m in re.findall("{[\w\.]+}", field):
-                            if m[1:-1] in metadata:
-                                v = v.replace(m, metadata[m[1:-1]])
-                    #elif fields[0] == ':'
-                    #    v = field[1:]
-                    #    for vs in [re.findall(v, k) for k in metadata]:
-                    #        pass
-                    elif field in metadata and metadata[field] is not None:
-                        v = metadata[field]
-                    else:
-                        v = default
-                    row[as_] = v
-                csv_w.writerow(row)
-        sys.stderr.write("Skipped %d\n" % skipped)
+                                pass
+                    if not include:
+                        skipped += 1
+                        continue
 
+                    metadata = _project_pag(pag, plan)
+
+                    row = []
+                    for as_, key, template, default in plan["columns"]:
+                        if template is not None:
+                            v = template
+                            for m, mkey in key:
+                                if mkey in metadata:
+                                    v = v.replace(m, metadata[mkey])
+                        elif key in metadata and metadata[key] is not None:
+                            v = metadata[key]
+                        else:
+                            v = default
+                        row.append(v)
+                    if sources:
+                        row = [row[i] for i in sources]
+                    csv_w.writerow(row)
+            sys.stderr.write("Skipped %d\n" % skipped)
+
+    _check_streamed_task(j, ("get", "result"))
     if args.task_del and j.get("task", {}).get("state", "") == "SUCCESS":
         j = util.emit(ocarina, ENDPOINTS["api.majora.task.delete"], v_args)
 
@@ -1020,139 +1424,136 @@ def wrap_get_sequencing(ocarina, args, metadata={}, metrics={}):
         else:
             j = util.emit(ocarina, ENDPOINTS["api.process.sequencing.get"], v_args)
 
-    status, j =_wait_for_task(ocarina, v_args, j, task_wait=args.task_wait)
+    status, j =_wait_for_task(ocarina, v_args, j, task_wait=args.task_wait, iter_path=("get", "result"))
 
-    if "get" not in j or "count" not in j["get"]:
+    if not _has_result(j):
         # Bad reply
         sys.exit(69) #EX_UNAVAILABLE
-    elif j["get"]["count"] == 0:
+    elif j["get"].get("count", 1) == 0:
         # No data in reply
         sys.exit(66) #EX_NOINPUT
-    if j["get"]["count"] >= 1 and v_args["tsv"]:
-        i = 0
-        header = None
+    if j["get"].get("count", 1) >= 1 and v_args["tsv"]:
+        # Rows are flattened and spilled to a temporary file in one pass over the
+        # result, as every row has a column for every meta and metric key seen in
+        # any row, and those are only all known at the end
+        spill = tempfile.SpooledTemporaryFile(max_size=jsonstream.CHUNK_SIZE * 16)
+
+        # Rows are kept as lists of column numbers and values against one shared
+        # ColumnIndex, rather than as a dict of every key for every row
+        columns = export.ColumnIndex()
+        meta_columns = set([])
+        row = export.RowBuffer(columns)
+        metric_prefix = flatten.prefix("metric.")
+        for run, run_d in _result_items(j["get"].get("result", {})):
+            libraries = run_d.get("libraries")
+            del run_d["libraries"]
+            for l in libraries:
+                if l["metadata"]:
+                    flat_meta = flatten.flatten_into(l["metadata"], {}, "meta.")
+                    meta_columns.update([columns[k] for k in flat_meta])
+                    l.update(flat_meta)
+                try:
+                    del l["metadata"]
+                except:
+                    pass
+                biosamples = l["biosamples"]
+                del l["biosamples"]
+
+                # The run and library part of every row in this library
+                lib_master = {}
+                lib_master.update(run_d)
+                lib_master.update(l)
+                lib_columns = [(columns[k], v) for k, v in lib_master.items()]
+
+                for b in biosamples:
+                    if args.faster:
+                        b = biosamples[b]
+
+                    # Flattened meta and metrics go in first, as they win over any
+                    # other key of the same name. Collect them from skipped rows
+                    # too, they still get a column.
+                    if b["metadata"]:
+                        flatten.flatten_into(b["metadata"], row, "meta.")
+                    if b["metrics"]:
+                        for tag in b["metrics"]:
+                            flatten.flatten_metrics_into(b["metrics"][tag], row, metric_prefix.child(tag))
+                    meta_columns.update(row.columns())
+
+                    skip = False
+                    adm1 = b.get("adm1")
+                    received_date = b.get("received_date")
+                    collection_date = b.get("collection_date")
+                    if not adm1 or len(adm1) == 0:
+                        skip = True
+                    if (not received_date or len(received_date)==0) and (not collection_date or len(collection_date)==0):
+                        skip = True
+
+                    if skip:
+                        if not v_args["tsv_show_dummy"]:
+                            sys.stderr.write("Skipping row: %s.%s.%s as it does not have a complete set of headers...\n" % (run, l["library_name"], b["central_sample_id"]))
+                            row.take()
+                            continue
 
-        if len(j["get"]["result"]) >= 1:
-            all_possible_meta_keys = set([])
-            for run in j["get"]["result"]:
-                for l in j["get"]["result"][run]["libraries"]:
-                    if l["metadata"]:
-                        flat_meta = {}
-                        for tag in l["metadata"]:
-                            for name in l["metadata"][tag]:
-                                flat_meta["meta.%s.%s" % (tag, name)] = l["metadata"][tag][name]
-                                all_possible_meta_keys.add("meta.%s.%s" % (tag, name))
-                        l.update(flat_meta)
-                    for b in l["biosamples"]:
-                        if args.faster:
-                            b = l["biosamples"][b]
-
-                        if b["metadata"]:
-
-                            flat_meta = {}
-                            for tag in b["metadata"]:
-                                for name in b["metadata"][tag]:
-                                    flat_meta["meta.%s.%s" % (tag, name)] = b["metadata"][tag][name]
-                                    all_possible_meta_keys.add("meta.%s.%s" % (tag, name))
-                            b.update(flat_meta)
-                        try:
-                            del b["metadata"]
-                        except:
-                            pass
-
-                        if b["metrics"]:
-                            flat_meta = {}
-                            for tag in b["metrics"]:
-                                for name in b["metrics"][tag]:
-                                    if name == "records":
-                                        for record_i, record in enumerate(b["metrics"][tag][name]):
-                                            for sub_name, sub_value in record.items():
-                                                flat_meta["metric.%s.%d.%s" % (tag, record_i+1, sub_name)] = sub_value
-                                                all_possible_meta_keys.add("metric.%s.%d.%s" % (tag, record_i+1, sub_name))
-                                    else:
-                                        flat_meta["metric.%s.%s" % (tag, name)] = b["metrics"][tag][name]
-                                        all_possible_meta_keys.add("metric.%s.%s" % (tag, name))
-                            b.update(flat_meta)
+                    # New "faster" endpoint integrates the single biosample_source
+                    if not args.faster:
                         try:
-                            del b["metrics"]
+                            row["biosample_source_id"] = b["biosample_sources"][0]["biosample_source_id"]
                         except:
-                            pass
-                    try:
-                        del l["metadata"]
-                    except:
-                        pass
-
-            for run in j["get"]["result"]:
-                row_master = j["get"]["result"][run]
-                libraries = row_master.get("libraries")
-                del row_master["libraries"]
-
-                for l in libraries:
-                    lib_master = l
-                    biosamples = lib_master["biosamples"]
-                    del lib_master["biosamples"]
-
-                    for mk in all_possible_meta_keys:
-                        if mk not in lib_master:
-                            lib_master[mk] = None
-
-                    for b in biosamples:
-                        if args.faster:
-                            b = biosamples[b]
-
-                        skip = False
-                        adm1 = b.get("adm1")
-                        received_date = b.get("received_date")
-                        collection_date = b.get("collection_date")
-                        if not adm1 or len(adm1) == 0:
-                            skip = True
-                        if (not received_date or len(received_date)==0) and (not collection_date or len(collection_date)==0):
-                            skip = True
-
-                        if skip:
-                            if not v_args["tsv_show_dummy"]:
-                                sys.stderr.write("Skipping row: %s.%s.%s as it does not have a complete set of headers...\n" % (run, l["library_name"], b["central_sample_id"]))
-                                continue
-
-                        # New "faster" endpoint integrates the single biosample_source
-                        if not args.faster:
-                            try:
-                                b["biosample_source_id"] = b["biosample_sources"][0]["biosample_source_id"]
-                            except:
-                                b["biosample_source_id"] = None
-
-                            try:
-                                del b["biosample_sources"]
-                            except:
-                                pass
-
-                        row = {}
-                        row.update(row_master)
-                        row.update(lib_master)
-                        row.update(b)
-
-                        fields = []
-                        for f in sorted(row):
-                            v_ = row[f]
-                            if type(row[f]) is bool:
-                                if row[f] is True:
-                                    v_ = 'Y'
-                                elif row[f] is False:
-                                    v_ = 'N'
-
-                            if row[f] is None or row[f] == "None":
-                                v_ = ""
-                            fields.append(str(v_))
-
-                        if i == 0:
-                            header = sorted(row)
-                            print("\t".join(header))
-                        if len(fields) != len(header):
-                            sys.stderr.write("Skipping row: %s.%s.%s as it does not have a complete set of headers...\n" % (run, l["library_name"], b["central_sample_id"]))
-                        else:
-                            print("\t".join(fields))
-
-                        i += 1
+                            row["biosample_source_id"] = ""
+                    for k, v in b.items():
+                        if k == "metadata" or k == "metrics" or (k == "biosample_sources" and not args.faster):
+                            continue
+                        row.setdefault(k, v)
+                    for c, v in lib_columns:
+                        row.setdefault_column(c, v)
+
+                    # Spill the row as it will be printed, missing meta keys are left out
+                    row_columns, row_values = row.take()
+                    spill.write(codec.dumps([run, l["library_name"], b["central_sample_id"], row_columns, row_values]))
+                    spill.write(b"\n")
+
+        spill.seek(0)
+        header = None
+        with export.OutputSink(args.output, args.output_compression) as out_f:
+            for line in spill:
+                run, library_name, central_sample_id, row_columns, row_values = codec.loads(line)
+
+                # Every row has all the meta columns and whatever else it has itself
+                extra = 0
+                in_header = True
+                for c in row_columns:
+                    if c not in meta_columns:
+                        extra += 1
+                    if header and position[c] < 0:
+                        in_header = False
+
+                if not header:
+                    header = sorted([columns.names[c] for c in meta_columns.union(row_columns)])
+                    position = [-1] * len(columns.names)
+                    for i, f in enumerate(header):
+                        position[columns[f]] = i
+                    out_f.write("\t".join(header) + "\n")
+                if len(meta_columns) + extra != len(header):
+                    sys.stderr.write("Skipping row: %s.%s.%s as it does not have a complete set of headers...\n" % (run, library_name, central_sample_id))
+                elif in_header:
+                    fields = [""] * len(header)
+                    for c, v in zip(row_columns, row_values):
+                        fields[position[c]] = _tsv_value(v)
+                    out_f.write("\t".join(fields) + "\n")
+                else:
+                    # Same number of columns as the header but not the same ones
+                    row_d = dict(zip([columns.names[c] for c in row_columns], row_values))
+                    fields = sorted(set([columns.names[c] for c in meta_columns]).union(row_d))
+                    out_f.write("\t".join([_tsv_value(row_d.get(f)) for f in fields]) + "\n")
+        spill.close()
+    _check_streamed_task(j, ("get", "result"))
+
+def _tsv_value(v):
+    if type(v) is bool:
+        v = 'Y' if v else 'N'
+    if v is None or v == "None":
+        return ""
+    return str(v)
 
 def wrap_sequencing_emit(ocarina, args, metadata={}, metrics={}):
     v_args = vars(args)
@@ -1239,7 +1640,23 @@ def wrap_digitalresource_emit(ocarina, args, metadata={}, metrics={}):
         print("Path does not appear to be a file")
         sys.exit(65) #EX_DATAERR
 
-    resource_hash = util.hashfile(path, force_hash=True)
+    hash_bs = ocarina.config.get("OCARINA_HASH_BLOCK_SIZE", util.HASH_BLOCK_SIZE)
+    hash_mmap = bool(ocarina.config.get("OCARINA_HASH_MMAP", 0))
+    if os.path.getsize(path) <= util.HASH_PARTIAL_LIMIT:
+        # current_hash is the MD5 of the whole file, make it with any others
+        digests = util.hashfile_digests(path, list(dict.fromkeys(["md5"] + args.digest)), bs=hash_bs, use_mmap=hash_mmap)
+        resource_hash = digests["md5"]
+    else:
+        # current_hash of a very large file is sampled as it always has been,
+        # but any other digests must cover the whole file to be of any use
+        resource_hash = util.hashfile(path, force_hash=True, bs=hash_bs, use_mmap=hash_mmap)
+        digests = util.hashfile_digests(path, args.digest, bs=hash_bs, use_mmap=hash_mmap) if args.digest else {}
+    # Add to a copy, as metadata may be the shared default (or the caller's)
+    metadata = dict(metadata)
+    if args.digest:
+        metadata["digest"] = dict(metadata.get("digest", {}))
+        for algorithm in args.digest:
+            metadata["digest"][algorithm] = digests[algorithm]
     resource_size = os.path.getsize(path)
     #node_uuid = "..."
     path = path
@@ -1463,3 +1880,166 @@ def wrap_publish_emit(ocarina, args, metadata={}, metrics={}):
 def wrap_pag_suppress(ocarina, args, metadata={}, metrics={}):
     v_args = vars(args)
     j = util.emit(ocarina, ENDPOINTS["api.group.pag.suppress"], v_args)
+
+
+BATCH_LIBRARY_BIOSAMPLE_FIELDS = [
+    "central_sample_id",
+    "library_source",
+    "library_selection",
+    "library_strategy",
+    "library_protocol",
+    "library_primers",
+    "sequencing_org_received_date",
+]
+
+def _read_table(path, delimiter=None):
+    if not delimiter:
+        delimiter = ',' if path.lower().endswith(".csv") else '\t'
+    with open(path, newline='') as table_fh:
+        for row in csv.DictReader(table_fh, delimiter=delimiter):
+            # Empty cells are unset, use _null_ to explicitly send a null
+            yield {k: (v if v != "" else None) for k, v in row.items()}
+
+def _fold_table_metadata(row):
+    # Turn meta.<tag>.<name> and metric.<namespace>.<name> columns back into
+    # the nested metadata and metrics dicts that the API expects
+    metadata = {}
+    metrics = {}
+    for key in list(row.keys()):
+        if key.startswith("meta.") or key.startswith("metric."):
+            value = row.pop(key)
+            ks = key.split('.', 2)
+            if value is None or len(ks) != 3:
+                continue
+            target = metadata if ks[0] == "meta" else metrics
+            if ks[1] not in target:
+                target[ks[1]] = {}
+            target[ks[1]][ks[2]] = value
+    row["metadata"] = metadata
+    row["metrics"] = metrics
+    return row
+
+def _read_batch_records(path, fmt=None):
+    if not fmt:
+        if path.lower().endswith(".jsonl") or path.lower().endswith(".json"):
+            fmt = "jsonl"
+        elif path.lower().endswith(".csv"):
+            fmt = "csv"
+        else:
+            fmt = "tsv"
+
+    records = []
+    if fmt == "jsonl":
+        with open(path) as batch_fh:
+            for line in batch_fh:
+                line = line.strip()
+                if not line:
+                    continue
+                records.append(codec.loads(line))
+        return records
+
+    libraries = {}
+    for row in _read_table(path, delimiter=',' if fmt == "csv" else '\t'):
+        row = _fold_table_metadata(row)
+        if row.get("action") == "library":
+            # Libraries span rows, one row for each biosample in the library
+            biosample = {k: row.pop(k, None) for k in BATCH_LIBRARY_BIOSAMPLE_FIELDS}
+            library_name = row.get("library_name")
+            if library_name not in libraries:
+                row["biosamples"] = []
+                libraries[library_name] = row
+                records.append(row)
+            libraries[library_name]["biosamples"].append(biosample)
+        else:
+            records.append(row)
+    return records
+
+def _submit_batch_record(ocarina, record):
+    action = record.get("action")
+    if action == "biosample":
+        # Drop unset fields as mixed tables will have columns for other actions
+        biosample = {k: v for k, v in record.items() if k not in ["action", "partial"] and v is not None}
+        if not biosample.get("metadata"):
+            biosample["metadata"] = {}
+        if not biosample.get("metrics"):
+            biosample["metrics"] = {}
+        if record.get("partial") and str(record["partial"]).lower() not in ["0", "n", "false"]:
+            payload = {"biosamples": [prune_null(biosample)]}
+            return True, util.emit(ocarina, ENDPOINTS["api.artifact.biosample.update"], payload, quiet=True)
+        else:
+            payload = {"biosamples": [biosample]}
+            return True, util.emit(ocarina, ENDPOINTS["api.artifact.biosample.add"], payload, quiet=True)
+    elif action == "library":
+        return ocarina.api.put_library(
+            library_name = record.get("library_name"),
+            biosamples = record.get("biosamples", []),
+            library_layout_config = record.get("library_layout_config"),
+            library_seq_kit = record.get("library_seq_kit"),
+            library_seq_protocol = record.get("library_seq_protocol"),
+            library_layout_insert_length = record.get("library_layout_insert_length"),
+            library_layout_read_length = record.get("library_layout_read_length"),
+            metadata = record.get("metadata"),
+            quiet = True,
+        )
+    elif action == "sequencing":
+        return ocarina.api.put_sequencing(
+            run_name = record.get("run_name"),
+            library_name = record.get("library_name"),
+            instrument_make = record.get("instrument_make"),
+            instrument_model = record.get("instrument_model"),
+            bioinfo_pipe_name = record.get("bioinfo_pipe_name"),
+            bioinfo_pipe_version = record.get("bioinfo_pipe_version"),
+            end_time = record.get("end_time"),
+            flowcell_id = record.get("flowcell_id"),
+            flowcell_type = record.get("flowcell_type"),
+            run_group = record.get("run_group"),
+            sequencing_id = record.get("sequencing_id"),
+            start_time = record.get("start_time"),
+            quiet = True,
+        )
+    else:
+        raise ValueError("unknown batch action '%s'" % action)
+
+def _run_batch_record(ocarina, record):
+    # One bad record should not take the rest of the batch down with it, the
+    # results TSV reports how each record went
+    code, ret, message = util.catch_exit(_submit_batch_record, ocarina, record)
+    if code:
+        return code, None, util.exit_message(code, message)
+    status, j = ret
+    return 0, j, ""
+
+def wrap_batch_emit(ocarina, args, metadata={}, metrics={}):
+    records = _read_batch_records(args.path, fmt=args.format)
+    if ocarina.oauth:
+        util.start_oauth_refresher(ocarina.config)
+    threads = args.threads if args.threads else ocarina.config.get("OCARINA_POOL_SIZE", 10)
+
+    if args.results == "-":
+        out_f = sys.stdout
+    else:
+        out_f = open(args.results, 'w')
+    results_w = csv.writer(out_f, delimiter='\t')
+    results_w.writerow(["record", "action", "name", "status", "exit_code", "errors", "warnings", "message"])
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        futures = {pool.submit(_run_batch_record, ocarina, record): (i, record) for i, record in enumerate(records)}
+        for future in as_completed(futures):
+            i, record = futures[future]
+            code, j, message = future.result()
+
+            errors = j.get("errors", 0) if j else ""
+            warnings = j.get("warnings", 0) if j else ""
+            ok = code == 0 and not errors
+            if not ok:
+                failed += 1
+            name = record.get("central_sample_id") or record.get("library_name") or record.get("run_name") or record.get("sequencing_id")
+            results_w.writerow([i+1, record.get("action"), name, "OK" if ok else "FAIL", code, errors, warnings, message])
+
+    if args.results != "-":
+        out_f.close()
+
+    sys.stderr.write("[BATCH] %d records submitted, %d failed\n" % (len(records), failed))
+    if failed:
+        sys.exit(1) #EX_GENERAL
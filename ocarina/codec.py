@@ -0,0 +1,70 @@
+import json
+import math
+
+# Use the fastest JSON library that is installed for request bodies, responses
+# and JSON output, falling back to the standard library if neither is around.
+# dumps always returns bytes, loads takes bytes or str.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+def _has_nonfinite(obj):
+    # True if obj holds a NaN or infinite float anywhere
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    elif isinstance(obj, dict):
+        return any(_has_nonfinite(v) for v in obj.values())
+    elif isinstance(obj, (list, tuple)):
+        return any(_has_nonfinite(v) for v in obj)
+    return False
+
+# The standard library reads and writes NaN and Infinity, which the faster
+# libraries refuse (or quietly write as null), so anything they cannot handle
+# falls back to json to give the same result whichever library is installed
+if orjson:
+    name = "orjson"
+
+    def loads(s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            return json.loads(s)
+
+    def dumps(obj):
+        try:
+            b = orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return json.dumps(obj).encode("utf-8")
+        if b"null" in b and _has_nonfinite(obj):
+            return json.dumps(obj).encode("utf-8")
+        return b
+
+elif ujson:
+    name = "ujson"
+
+    def loads(s):
+        try:
+            return ujson.loads(s)
+        except ValueError:
+            return json.loads(s)
+
+    def dumps(obj):
+        try:
+            return ujson.dumps(obj, ensure_ascii=False).encode("utf-8")
+        except (OverflowError, TypeError):
+            return json.dumps(obj).encode("utf-8")
+
+else:
+    name = "json"
+
+    def loads(s):
+        return json.loads(s)
+
+    def dumps(obj):
+        return json.dumps(obj).encode("utf-8")
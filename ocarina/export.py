@@ -0,0 +1,252 @@
+import csv
+import gzip
+import io
+import sys
+import tempfile
+
+from . import codec
+from . import jsonstream
+
+# pyarrow is only needed to write Arrow IPC or Parquet tables
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# zstandard is only needed to write zstd compressed output
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+TABLE_FORMATS = ["delimited", "arrow", "parquet"]
+ARROW_BATCH_SIZE = 10000
+
+OUTPUT_COMPRESSION = ["auto", "none", "gzip", "zstd"]
+OUTPUT_BUFFER_SIZE = 1024 * 1024 # 1MiB
+
+class OutputSink:
+    # Open path ("-" for stdout) to write through a large buffer, compressing
+    # with gzip or zstd on the way. With compression auto, files ending .gz or
+    # .zst are compressed and anything else (including stdout) is not.
+    # Use as a context manager for the file to write to, text unless binary is
+    # set. Closing flushes and closes every layer, but never stdout itself.
+    def __init__(self, path="-", compression="auto", binary=False):
+        if not compression or compression == "auto":
+            if path.endswith(".gz"):
+                compression = "gzip"
+            elif path.endswith(".zst"):
+                compression = "zstd"
+            else:
+                compression = "none"
+        if compression == "zstd" and not zstandard:
+            sys.stderr.write("zstandard is required to write zstd output, try `pip install ocarina[zstd]`\n")
+            sys.exit(64) #EX_USAGE
+
+        self.path = path
+        self._base = None
+        self._buffer = None
+        self._compressor = None
+        self._text = None
+
+        if path == "-":
+            sys.stdout.flush()
+            base = getattr(sys.stdout, "buffer", None)
+            if base is None and not binary and compression == "none":
+                # stdout has been replaced with something text only, just use it
+                self.fh = sys.stdout
+                return
+        else:
+            base = open(path, 'wb', buffering=0)
+            self._base = base
+
+        self._buffer = fh = io.BufferedWriter(base, buffer_size=OUTPUT_BUFFER_SIZE)
+        if compression == "gzip":
+            self._compressor = fh = gzip.GzipFile(fileobj=fh, mode='wb')
+        elif compression == "zstd":
+            self._compressor = fh = zstandard.ZstdCompressor().stream_writer(fh, closefd=False)
+        if not binary:
+            # newline is left alone so csv line endings are written as they always were
+            self._text = fh = io.TextIOWrapper(fh, encoding="utf-8", newline="")
+        self.fh = fh
+
+    def __enter__(self):
+        return self.fh
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        # Wrappers are detached rather than closed so stdout is left open
+        if self._text:
+            self._text.detach()
+            self._text = None
+        if self._compressor:
+            self._compressor.close()
+            self._compressor = None
+        if self._buffer:
+            self._buffer.detach().flush()
+            self._buffer = None
+        if self._base:
+            self._base.close()
+            self._base = None
+
+class ColumnIndex(dict):
+    # Number each column name the first time it is seen, so rows can be kept as
+    # lists of column numbers and values that share the one set of names
+    __slots__ = ("names",)
+
+    def __init__(self):
+        super().__init__()
+        self.names = []
+
+    def __missing__(self, name):
+        i = self[name] = len(self.names)
+        self.names.append(name)
+        return i
+
+_UNSET = object()
+
+class RowBuffer:
+    # Build rows one at a time as (columns, values) lists against a ColumnIndex,
+    # using one reusable array of slots rather than a new dict for every row.
+    # Setting a column again replaces its value, as dict.update would, and
+    # setdefault only sets a column that has not been set yet.
+    __slots__ = ("index", "_slots", "_columns")
+
+    def __init__(self, index):
+        self.index = index
+        self._slots = []
+        self._columns = []
+
+    def __setitem__(self, name, value):
+        self.set_column(self.index[name], value)
+
+    def set_column(self, c, value):
+        slots = self._slots
+        if c >= len(slots):
+            slots.extend([_UNSET] * (c + 1 - len(slots)))
+        if slots[c] is _UNSET:
+            self._columns.append(c)
+        slots[c] = value
+
+    def setdefault(self, name, value):
+        self.setdefault_column(self.index[name], value)
+
+    def setdefault_column(self, c, value):
+        slots = self._slots
+        if c >= len(slots):
+            slots.extend([_UNSET] * (c + 1 - len(slots)))
+        if slots[c] is _UNSET:
+            self._columns.append(c)
+            slots[c] = value
+
+    def columns(self):
+        # The column numbers set so far, in the order they were first set
+        return self._columns
+
+    def take(self):
+        # Return the row as (columns, values) and empty the buffer for the next one
+        slots = self._slots
+        columns = self._columns
+        values = [slots[c] for c in columns]
+        for c in columns:
+            slots[c] = _UNSET
+        self._columns = []
+        return columns, values
+
+class TableSpill:
+    # Collect the rows of a table into a temporary file (kept in memory up to
+    # 16MiB) while finding its columns, in the order they were first seen, and
+    # the types of the values in each column. Once every row has been added the
+    # schema is known and the rows can be read back to be written out.
+    def __init__(self):
+        self.columns = {}
+        self.n_rows = 0
+        self._fh = tempfile.SpooledTemporaryFile(max_size=jsonstream.CHUNK_SIZE * 16)
+
+    def add(self, row):
+        columns = self.columns
+        for k, v in row.items():
+            if k not in columns:
+                columns[k] = set([])
+            if v is not None:
+                columns[k].add(type(v))
+        self._fh.write(codec.dumps(row))
+        self._fh.write(b"\n")
+        self.n_rows += 1
+
+    def rows(self):
+        self._fh.seek(0)
+        for line in self._fh:
+            yield codec.loads(line)
+
+    def close(self):
+        self._fh.close()
+
+def write_delimited(spill, fh, delimiter='\t'):
+    header = list(spill.columns)
+    csv_w = csv.writer(fh, delimiter=delimiter)
+    csv_w.writerow(header)
+    for row in spill.rows():
+        csv_w.writerow([row.get(k) for k in header])
+
+def _arrow_type(types):
+    # Pick the narrowest Arrow type that holds every value seen in a column,
+    # anything mixed or nested is written as a string
+    if not types:
+        return pyarrow.string()
+    elif types == {bool}:
+        return pyarrow.bool_()
+    elif types == {int}:
+        return pyarrow.int64()
+    elif types <= {int, float}:
+        return pyarrow.float64()
+    return pyarrow.string()
+
+def _arrow_value(v):
+    if v is None or isinstance(v, str):
+        return v
+    elif isinstance(v, (dict, list)):
+        return codec.dumps(v).decode("utf-8")
+    return str(v)
+
+def write_arrow(spill, fh, fmt="arrow"):
+    # Write the spilled table to the binary file handle fh as an Arrow IPC file
+    # or Parquet, ARROW_BATCH_SIZE rows at a time
+    if not pyarrow:
+        sys.stderr.write("pyarrow is required to write %s tables, try `pip install ocarina[arrow]`\n" % fmt)
+        sys.exit(64) #EX_USAGE
+
+    header = list(spill.columns)
+    types = [_arrow_type(spill.columns[k]) for k in header]
+    as_string = [t == pyarrow.string() for t in types]
+    schema = pyarrow.schema([pyarrow.field(k, t) for k, t in zip(header, types)])
+
+    if fmt == "parquet":
+        writer = pyarrow.parquet.ParquetWriter(fh, schema)
+        write = lambda batch: writer.write_table(pyarrow.Table.from_batches([batch]))
+    else:
+        writer = pyarrow.ipc.new_file(fh, schema)
+        write = writer.write_batch
+
+    def flush(columns):
+        arrays = [pyarrow.array(values, type=t) for values, t in zip(columns, types)]
+        write(pyarrow.RecordBatch.from_arrays(arrays, schema=schema))
+
+    columns = [[] for k in header]
+    n = 0
+    for row in spill.rows():
+        for i, k in enumerate(header):
+            v = row.get(k)
+            columns[i].append(_arrow_value(v) if as_string[i] else v)
+        n += 1
+        if n == ARROW_BATCH_SIZE:
+            flush(columns)
+            columns = [[] for k in header]
+            n = 0
+    if n or not spill.n_rows:
+        flush(columns)
+    writer.close()
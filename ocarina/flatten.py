@@ -0,0 +1,123 @@
+import sys
+
+# Flattened keys (eg. meta.epi.cluster) are built from a prefix and a name. The
+# same few thousand keys turn up on every row of a large result, so each one is
+# built once, interned and looked up from its KeyPrefix afterwards, rather than
+# being formatted again (and allocated again) for every row.
+
+class KeyPrefix(dict):
+    # Map a name to the interned key prefix + name, building keys on demand.
+    # children maps a name to the KeyPrefix for keys under it in the same way.
+    __slots__ = ("prefix", "children")
+
+    def __init__(self, prefix):
+        super().__init__()
+        self.prefix = prefix
+        self.children = _Children(prefix)
+
+    def __missing__(self, name):
+        key = self[name] = sys.intern("%s%s" % (self.prefix, name))
+        return key
+
+    def child(self, name):
+        # Return the KeyPrefix for keys under name, ie. prefix + name + "."
+        return self.children[name]
+
+class _Children(dict):
+    __slots__ = ("prefix",)
+
+    def __init__(self, prefix):
+        super().__init__()
+        self.prefix = prefix
+
+    def __missing__(self, name):
+        child = self[name] = KeyPrefix("%s%s." % (self.prefix, name))
+        return child
+
+_prefixes = {}
+
+def prefix(p=""):
+    # Return the shared KeyPrefix for the string p
+    try:
+        return _prefixes[p]
+    except KeyError:
+        key_prefix = _prefixes[p] = KeyPrefix(p)
+        return key_prefix
+
+def _as_prefix(p):
+    return p if isinstance(p, KeyPrefix) else prefix(p)
+
+def flatten_into(obj, into, key_prefix="", depth=2):
+    # Copy each value of the dict obj into the dict into under its flattened
+    # key, descending into dicts so that a key has at most depth parts. Dicts any
+    # deeper are copied as they are. Uses a stack rather than recursion.
+    keys = _as_prefix(key_prefix)
+    if depth <= 2:
+        # Most things only go one level deep, which needs no stack at all
+        children = keys.children
+        for k, v in obj.items():
+            if depth == 2 and type(v) is dict:
+                child = children[k]
+                for sub_k, sub_v in v.items():
+                    into[child[sub_k]] = sub_v
+            else:
+                into[keys[k]] = v
+        return into
+
+    stack = [(keys, iter(obj.items()), depth)]
+    while stack:
+        keys, items, d = stack[-1]
+        if d > 1:
+            for k, v in items:
+                if type(v) is dict:
+                    stack.append((keys.children[k], iter(v.items()), d - 1))
+                    break
+                into[keys[k]] = v
+            else:
+                stack.pop()
+        else:
+            for k, v in items:
+                into[keys[k]] = v
+            stack.pop()
+    return into
+
+def flatten(obj, key_prefix="", depth=2):
+    # As flatten_into, but yield each (key, value) in the order they appear,
+    # nested keys in place of their parent
+    stack = [(_as_prefix(key_prefix), iter(obj.items()), depth)]
+    while stack:
+        keys, items, d = stack[-1]
+        for k, v in items:
+            if d > 1 and type(v) is dict:
+                stack.append((keys.child(k), iter(v.items()), d - 1))
+                break
+            yield keys[k], v
+        else:
+            stack.pop()
+
+def flatten_metrics_into(values, into, key_prefix):
+    # Copy the metrics of one namespace into the dict into, where key_prefix is
+    # the namespace prefix (eg. metric.ct.). Records are numbered from 1 and each
+    # of their values is copied as key_prefix<i>.<name>
+    keys = _as_prefix(key_prefix)
+    for name, value in values.items():
+        if name == "records":
+            for record_i, record in enumerate(value):
+                record_keys = keys.children[record_i + 1]
+                for sub_name, sub_value in record.items():
+                    into[record_keys[sub_name]] = sub_value
+        else:
+            into[keys[name]] = value
+    return into
+
+def flatten_metrics(values, key_prefix):
+    # As flatten_metrics_into, but yield (key, value, is_record) in order
+    keys = _as_prefix(key_prefix)
+    for name, value in values.items():
+        if name == "records":
+            for record_i, record in enumerate(value):
+                record_keys = keys.child(record_i + 1)
+                for sub_name, sub_value in record.items():
+                    yield record_keys[sub_name], sub_value, True
+        else:
+            yield keys[name], value, False
@@ -0,0 +1,290 @@
+import re
+import json
+
+# Bytes that matter when skipping over a JSON value. Every one of these is ASCII
+# so it can never appear inside a multi-byte UTF-8 character, which lets us find
+# value boundaries without decoding anything.
+_CONTAINER_SPECIAL = re.compile(rb'["\[\]{}]')
+_STRING_SPECIAL = re.compile(rb'["\\]')
+_SCALAR_END = re.compile(rb'[,\]}\s]')
+_WHITESPACE = b" \t\r\n"
+
+CHUNK_SIZE = 1048576 # 1MiB
+
+class JsonPathStream:
+    # Incrementally parse a JSON object from an iterable of bytes chunks.
+    # Everything outside of the container at path is decoded into head as it is
+    # reached, but the value at path is left on the stream for the caller to
+    # consume one element at a time with items(), or copy out raw with copy_to().
+    def __init__(self, chunks, path, loads=json.loads, close=None):
+        self._chunks = iter(chunks)
+        self._buf = b""
+        self._pos = 0
+        self._close = close
+        self.path = tuple(path)
+        self.loads = loads
+
+        self.head = {}
+        self.consumed = False
+        self._walker = self._walk(0, self.head)
+        try:
+            next(self._walker)
+            self.found = True
+        except StopIteration:
+            self.found = False
+            self.close()
+
+    def close(self):
+        if self._close:
+            self._close()
+            self._close = None
+
+    def _fill(self):
+        for chunk in self._chunks:
+            if chunk:
+                self._buf = self._buf[self._pos:] + bytes(chunk)
+                self._pos = 0
+                return True
+        return False
+
+    def _peek(self):
+        while True:
+            buf = self._buf
+            pos = self._pos
+            while pos < len(buf) and buf[pos] in _WHITESPACE:
+                pos += 1
+            self._pos = pos
+            if pos < len(buf):
+                return buf[pos:pos+1]
+            if not self._fill():
+                return b""
+
+    def _lookahead(self, offset):
+        # Like _peek, but for the next byte after offset and without consuming anything
+        while True:
+            buf = self._buf
+            pos = self._pos + offset
+            while pos < len(buf) and buf[pos] in _WHITESPACE:
+                pos += 1
+            if pos < len(buf):
+                return buf[pos:pos+1]
+            if not self._fill():
+                return b""
+
+    def _expect(self, c):
+        found = self._peek()
+        if found != c:
+            raise ValueError("Expected %s but found %s in JSON stream" % (c, found if found else "end of stream"))
+        self._pos += 1
+
+    def _read_value(self, sink):
+        # Pass the raw bytes of the next value to sink, in one or more pieces
+        c = self._peek()
+        if not c:
+            raise ValueError("Unexpected end of JSON stream")
+        elif c in b'"{[':
+            self._scan(sink)
+        else:
+            self._scan_scalar(sink)
+
+    def _scan(self, sink):
+        buf = self._buf
+        pos = start = self._pos
+        depth = 0
+        in_string = False
+        while True:
+            if pos >= len(buf):
+                sink(buf[start:])
+                overflow = pos - len(buf) # an escape can straddle two chunks
+                self._pos = len(buf)
+                if not self._fill():
+                    raise ValueError("Unexpected end of JSON stream")
+                buf = self._buf
+                start = self._pos
+                pos = start + overflow
+                continue
+
+            if in_string:
+                m = _STRING_SPECIAL.search(buf, pos)
+                if not m:
+                    pos = len(buf)
+                elif buf[m.start()] == 0x5c: # backslash, skip whatever it escapes
+                    pos = m.start() + 2
+                else:
+                    pos = m.end()
+                    in_string = False
+                    if depth == 0:
+                        break
+            else:
+                m = _CONTAINER_SPECIAL.search(buf, pos)
+                if not m:
+                    pos = len(buf)
+                    continue
+                c = buf[m.start()]
+                pos = m.end()
+                if c == 0x22: # "
+                    in_string = True
+                elif c == 0x7b or c == 0x5b: # { [
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 0:
+                        break
+
+        sink(buf[start:pos])
+        self._pos = pos
+
+    def _scan_scalar(self, sink):
+        buf = self._buf
+        pos = self._pos
+        while True:
+            m = _SCALAR_END.search(buf, pos)
+            if m:
+                sink(buf[pos:m.start()])
+                self._pos = m.start()
+                return
+            sink(buf[pos:])
+            self._pos = len(buf)
+            if not self._fill():
+                return
+            buf = self._buf
+            pos = self._pos
+
+    def _read_bytes(self):
+        parts = []
+        self._read_value(parts.append)
+        return b"".join(parts)
+
+    def _walk(self, depth, into):
+        self._expect(b"{")
+        if self._peek() == b"}":
+            self._pos += 1
+            return
+        while True:
+            key = self.loads(self._read_bytes())
+            self._expect(b":")
+            if key == self.path[depth] and depth == len(self.path) - 1:
+                # Hand over to the caller to consume the value
+                yield
+            elif key == self.path[depth] and self._peek() == b"{":
+                into[key] = {}
+                yield from self._walk(depth + 1, into[key])
+            else:
+                into[key] = self.loads(self._read_bytes())
+
+            c = self._peek()
+            self._pos += 1
+            if c == b"}":
+                return
+            elif c != b",":
+                raise ValueError("Expected , or } but found %s in JSON stream" % (c if c else "end of stream"))
+
+    def _finish(self):
+        # Decode whatever is left after the target into head
+        for _ in self._walker:
+            self._read_bytes() # duplicate keys are skipped
+        self.close()
+
+    def _iter_container(self, close):
+        if self._peek() == close:
+            self._pos += 1
+            return
+        while True:
+            yield
+            c = self._peek()
+            self._pos += 1
+            if c == close:
+                return
+            elif c != b",":
+                raise ValueError("Expected , or %s but found %s in JSON stream" % (close, c if c else "end of stream"))
+
+    def items(self):
+        # Yield each element of a list at path, or each (key, value) of an object
+        if not self.found or self.consumed:
+            return
+        self.consumed = True
+
+        c = self._peek()
+        if c == b"[":
+            self._pos += 1
+            for _ in self._iter_container(b"]"):
+                yield self.loads(self._read_bytes())
+        elif c == b"{":
+            self._pos += 1
+            for _ in self._iter_container(b"}"):
+                key = self.loads(self._read_bytes())
+                self._expect(b":")
+                yield key, self.loads(self._read_bytes())
+        else:
+            # Nothing to iterate over (probably null)
+            self._read_bytes()
+        self._finish()
+
+    def __iter__(self):
+        return self.items()
+
+    def __bool__(self):
+        # Mirror the truthiness of the decoded value for null, false, [] and {}
+        if not self.found or self.consumed:
+            return False
+        c = self._peek()
+        if c == b"[":
+            return self._lookahead(1) != b"]"
+        elif c == b"{":
+            return self._lookahead(1) != b"}"
+        return c not in [b"n", b"f"]
+
+    def skip(self):
+        # Pass over the value at path without decoding it, decoding the rest of
+        # the document into head
+        if not self.found or self.consumed:
+            return
+        self.consumed = True
+        self._read_value(lambda b: None)
+        self._finish()
+
+    def copy_to(self, fh):
+        # Write the raw bytes of the value at path to the binary file handle fh
+        # without decoding any of it, returning the number of bytes written
+        if not self.found or self.consumed:
+            return 0
+        self.consumed = True
+
+        written = [0]
+        def sink(b):
+            if b:
+                fh.write(b)
+                written[0] += len(b)
+        self._read_value(sink)
+        self._finish()
+        return written[0]
+
+def stream_json(chunks, path, loads=json.loads, close=None):
+    # Return the document with the value at path replaced by a JsonPathStream
+    # that can be iterated over, or copied out, without decoding it all at once.
+    # The rest of the document is decoded as normal.
+    stream = JsonPathStream(chunks, path, loads=loads, close=close)
+    if stream.found:
+        parent = stream.head
+        for key in stream.path[:-1]:
+            parent = parent[key]
+        parent[stream.path[-1]] = stream
+    return stream.head
+
+def read_around(chunks, path, loads=json.loads):
+    # Decode the document without the value at path, which is skipped over
+    # without being decoded. Keys that follow path (eg. task) are otherwise only
+    # in the head of a JsonPathStream once it has been consumed, so callers with
+    # the whole document to hand can use this to see them up front.
+    stream = JsonPathStream(chunks, path, loads=loads)
+    stream.skip()
+    return stream.head
+
+def merge_missing(into, d):
+    # Copy each key of d that is missing from into, merging nested dicts
+    for k, v in d.items():
+        if k not in into:
+            into[k] = v
+        elif type(into[k]) is dict and type(v) is dict:
+            merge_missing(into[k], v)
+    return into
@@ -0,0 +1,71 @@
+import os
+import sys
+import time
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class TokenBucket:
+    # Allow up to burst requests at once, refilling at rate requests per second.
+    # With a state_path the bucket is kept in a small file under an flock so that
+    # every ocarina process on this host draws from the same allowance.
+    def __init__(self, rate, burst=None, state_path=None):
+        self.rate = float(rate)
+        self.burst = max(1, int(burst if burst else rate))
+        self.state_path = state_path
+
+        if self.state_path and not fcntl:
+            sys.stderr.write("[WARN] Cannot share the rate limit between processes on this platform, limiting this process only\n")
+            self.state_path = None
+
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._stamp = time.time()
+
+    def _refill(self, tokens, stamp, now):
+        tokens = min(self.burst, tokens + max(0, now - stamp) * self.rate)
+        if tokens >= 1:
+            return tokens - 1, 0
+        return tokens, (1 - tokens) / self.rate
+
+    def _take(self):
+        now = time.time()
+        self._tokens, wait = self._refill(self._tokens, self._stamp, now)
+        self._stamp = now
+        return wait
+
+    def _take_shared(self):
+        # Create as 600 with the mode rather than the umask, which is shared by
+        # every thread in the process
+        fd = os.open(self.state_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            now = time.time()
+            try:
+                tokens, stamp = [float(x) for x in os.read(fd, 64).decode().split()]
+            except ValueError:
+                # New or mangled state, start with a full bucket
+                tokens, stamp = float(self.burst), now
+            tokens, wait = self._refill(tokens, stamp, now)
+
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, ("%f %f" % (tokens, now)).encode())
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        return wait
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                if self.state_path:
+                    wait = self._take_shared()
+                else:
+                    wait = self._take()
+            if wait <= 0:
+                return
+            time.sleep(wait)
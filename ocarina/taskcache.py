@@ -0,0 +1,103 @@
+import os
+import time
+import hashlib
+import tempfile
+
+class TaskCache:
+    # Keep the response bodies of finished tasks on disk, named for a hash of
+    # the namespace (the Majora domain and user they were fetched for), the
+    # endpoint and task ID so one user never reads another's results.
+    # Entries expire ttl seconds after they were written, and the least
+    # recently read entries are evicted whenever the cache grows past max_bytes.
+    # An entry's mtime is when it was written and its atime is when it was last
+    # read, atime is set by hand so it does not matter how the disk is mounted.
+    def __init__(self, path, ttl, max_bytes, namespace=""):
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+
+    def _entry_path(self, endpoint, task_id):
+        key = hashlib.sha256(("%s %s %s" % (self.namespace, endpoint, task_id)).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, key + ".json")
+
+    def get(self, endpoint, task_id):
+        # Return an open binary file handle for the cached body, or None
+        path = self._entry_path(endpoint, task_id)
+        try:
+            fh = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+
+        st = os.fstat(fh.fileno())
+        now = time.time()
+        if now - st.st_mtime > self.ttl:
+            fh.close()
+            self._remove(path)
+            return None
+        os.utime(path, (now, st.st_mtime))
+        return fh
+
+    def writer(self, endpoint, task_id):
+        return TaskCacheWriter(self, self._entry_path(endpoint, task_id))
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith(".json") and not name.endswith(".tmp"):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if now - st.st_mtime > self.ttl:
+                # Also clears out any temporary files left by a writer that died
+                self._remove(path)
+                continue
+            if name.endswith(".tmp"):
+                continue
+            entries.append((st.st_atime, st.st_size, path))
+            total += st.st_size
+
+        # Least recently read first
+        for atime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+class TaskCacheWriter:
+    # Write a body to a temporary file next to the cache entry, which is only
+    # renamed into place by commit once the caller knows the task finished
+    def __init__(self, cache, path):
+        self.cache = cache
+        self.path = path
+        fd, self.tmp_path = tempfile.mkstemp(dir=cache.path, suffix=".tmp")
+        self.fh = os.fdopen(fd, 'wb')
+
+    def write(self, b):
+        self.fh.write(b)
+
+    def open(self):
+        # Flush what has been written and return a fresh handle to read it back
+        self.fh.flush()
+        return open(self.tmp_path, 'rb')
+
+    def commit(self):
+        self.fh.close()
+        os.replace(self.tmp_path, self.path)
+        self.cache.evict()
+
+    def abort(self):
+        self.fh.close()
+        self.cache._remove(self.tmp_path)
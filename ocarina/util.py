@@ -2,15 +2,37 @@ import os
 import stat
 import sys
 import json
+import time
+import contextlib
+import random
+import gzip
+import io
+import math
+import mmap
 import hashlib
-from datetime import datetime
+import tempfile
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth2Session, TokenUpdated
+from oauthlib.oauth2.rfc6749.errors import OAuth2Error
 
 from ffurf import FfurfConfig
 
+from . import codec
 from . import version
+from . import jsonstream
+from .ratelimit import TokenBucket
+from .taskcache import TaskCache
 
 def check_and_warn_permissions(file_path):
     file_mode = os.stat(file_path).st_mode
@@ -18,6 +40,10 @@ def check_and_warn_permissions(file_path):
         file_mode_oct = oct(file_mode)[-3:]
         sys.stderr.write("[WARN] Permissions %s for %s are too open and may allow other users to read or write your tokens!\n" % (file_mode_oct, file_path))
 
+HASH_BLOCK_SIZE = 1024 * 1024 # 1MiB
+PARTIAL_BLOCK_SIZE = 65536 # block size partial hashes of very large files are sampled in
+HASH_PARTIAL_LIMIT = 10737418240 # 10GiB, hashfile samples files larger than this
+
 class OcarinaConfig(FfurfConfig):
     def __init__(self):
         super().__init__()
@@ -29,6 +55,21 @@ class OcarinaConfig(FfurfConfig):
         self.add_config_key("CLIENT_SECRET", secret=True)
         self.add_config_key("OCARINA_NO_BANNER", key_type=int, default_value=0)
         self.add_config_key("OCARINA_QUIET", key_type=int, default_value=0)
+        self.add_config_key("OCARINA_POOL_SIZE", key_type=int, default_value=10)
+        self.add_config_key("OCARINA_RETRY_ATTEMPTS", key_type=int, default_value=3)
+        self.add_config_key("OCARINA_RETRY_BACKOFF", key_type=int, default_value=2)
+        self.add_config_key("OCARINA_RETRY_MAX_WAIT", key_type=int, default_value=120)
+        self.add_config_key("OCARINA_RATE_LIMIT", key_type=float, default_value=0)
+        self.add_config_key("OCARINA_RATE_BURST", key_type=int, default_value=0)
+        self.add_config_key("OCARINA_RATE_SHARED", key_type=int, default_value=0)
+        self.add_config_key("OCARINA_TOKEN_REFRESH_MARGIN", key_type=int, default_value=300)
+        self.add_config_key("OCARINA_GZIP_THRESHOLD", key_type=int, default_value=0)
+        self.add_config_key("OCARINA_CACHE_DIR", default_value=os.path.expanduser("~/.cache/ocarina/tasks"))
+        self.add_config_key("OCARINA_CACHE_TTL", key_type=int, default_value=0)
+        self.add_config_key("OCARINA_CACHE_SIZE", key_type=int, default_value=1024)
+        self.add_config_key("OCARINA_SPOOL_THRESHOLD", key_type=int, default_value=0)
+        self.add_config_key("OCARINA_HASH_BLOCK_SIZE", key_type=int, default_value=HASH_BLOCK_SIZE)
+        self.add_config_key("OCARINA_HASH_MMAP", key_type=int, default_value=0)
 
 def get_config(env=False, profile=None):
 
@@ -95,22 +136,135 @@ def oauth_load_tokens(tokens_path):
     else:
         return {}
 
-def oauth_save_token(tokens_path, token):
-    tokens = oauth_load_tokens(tokens_path)
-    scope = " ".join(token["scope"])
-    tokens[scope] = token
+@contextlib.contextmanager
+def oauth_tokens_lock(tokens_path):
+    # Serialise writers of the tokens file across processes with an flock on a
+    # sidecar lock file, readers never need it as the tokens file is only ever
+    # replaced with an atomic rename
+    if not fcntl:
+        yield
+        return
+    # Created as 600 with the mode, as the umask is shared with the refresher
+    # and emit worker threads
+    fd = os.open(tokens_path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+def _oauth_write_tokens(tokens_path, tokens):
+    # mkstemp creates the file as 600 so there is no need to touch the umask
+    tokens_dir = os.path.dirname(os.path.abspath(tokens_path))
+    fd, tmp_path = tempfile.mkstemp(dir=tokens_dir, prefix=".%s." % os.path.basename(tokens_path))
+    try:
+        with os.fdopen(fd, 'w') as config_fh:
+            json.dump(tokens, config_fh)
+            config_fh.flush()
+            os.fsync(config_fh.fileno())
+        os.replace(tmp_path, tokens_path)
+    except:
+        os.unlink(tmp_path)
+        raise
 
-    old_mask = os.umask(0o177) # mask to 600
-    with open(tokens_path, 'w') as config_fh:
-        json.dump(tokens, config_fh)
-    os.umask(old_mask)
+def oauth_save_token(tokens_path, token):
+    with oauth_tokens_lock(tokens_path):
+        tokens = oauth_load_tokens(tokens_path)
+        scope = " ".join(token["scope"])
+        tokens[scope] = token
+        _oauth_write_tokens(tokens_path, tokens)
+
+def oauth_refresh_token(config, oauth_scope, token, force=False):
+    # Single-flight refresh, whoever gets the lock first does the refresh and
+    # everyone else waiting on the lock picks up the new token from the file
+    tokens_path = config["MAJORA_TOKENS_FILE"]
+    with oauth_tokens_lock(tokens_path):
+        tokens = oauth_load_tokens(tokens_path)
+        current = tokens.get(oauth_scope, token)
+        if not force and current.get("access_token") != token.get("access_token"):
+            if current.get("expires_at", 0) - OAUTH_EXPIRY_MARGIN > time.time():
+                return current
+
+        new_token = _oauth_request_refresh(config, oauth_scope, current)
+        tokens[" ".join(new_token["scope"])] = new_token
+        _oauth_write_tokens(tokens_path, tokens)
+    return new_token
+
+def _oauth_request_refresh(config, oauth_scope, token):
+    session = OAuth2Session(client_id=config["CLIENT_ID"], token=token, scope=oauth_scope)
+    refresh_params = {
+        "client_id": config["CLIENT_ID"],
+        "client_secret": config["CLIENT_SECRET"],
+    }
+    return session.refresh_token(config["MAJORA_DOMAIN"]+"o/token/", **refresh_params)
+
+def _oauth_timed_refresh(config, oauth_scope, token):
+    start_time = time.time()
+    try:
+        new_token = _oauth_request_refresh(config, oauth_scope, token)
+        error = None
+    except (OAuth2Error, requests.exceptions.RequestException) as e:
+        new_token = None
+        error = str(e)
+    return oauth_scope, new_token, time.time() - start_time, error
+
+def oauth_refresh_all(config, scopes=None, threads=10):
+    # Refresh every scope in the tokens file at once, writing the file a single
+    # time at the end. Returns a list of (scope, new_token, seconds, error)
+    tokens_path = config["MAJORA_TOKENS_FILE"]
+    with oauth_tokens_lock(tokens_path):
+        tokens = oauth_load_tokens(tokens_path)
+        if not scopes:
+            scopes = list(tokens.keys())
+
+        results = []
+        to_refresh = []
+        for scope in scopes:
+            if not tokens.get(scope, {}).get("refresh_token"):
+                results.append((scope, None, 0, "no refresh token"))
+            else:
+                to_refresh.append(scope)
+
+        if to_refresh:
+            with ThreadPoolExecutor(max_workers=max(1, min(threads, len(to_refresh)))) as pool:
+                futures = [pool.submit(_oauth_timed_refresh, config, scope, tokens[scope]) for scope in to_refresh]
+                results.extend([f.result() for f in futures])
+
+        for scope, new_token, seconds, error in results:
+            if new_token:
+                tokens[" ".join(new_token["scope"])] = new_token
+        _oauth_write_tokens(tokens_path, tokens)
+    return results
+
+def _oauth_session_for_token(config, oauth_scope, token):
+    return OAuth2Session(
+            client_id=config["CLIENT_ID"],
+            token=token,
+            scope=oauth_scope,
+            auto_refresh_url=config["MAJORA_DOMAIN"]+"o/token/",
+            auto_refresh_kwargs={
+                "client_id": config["CLIENT_ID"],
+                "client_secret": config["CLIENT_SECRET"],
+            },
+    )
 
 def handle_oauth(config, oauth_scope, force_refresh=False, interactive=True):
     tokens = oauth_load_tokens(config["MAJORA_TOKENS_FILE"])
     if oauth_scope in tokens:
         # Check that token is valid
         if datetime.fromtimestamp(tokens[oauth_scope]["expires_at"]) <= datetime.now():
-            if interactive:
+            # Try the refresh token before falling back to asking for a new grant
+            token = None
+            if tokens[oauth_scope].get("refresh_token"):
+                try:
+                    token = oauth_refresh_token(config, oauth_scope, tokens[oauth_scope])
+                except (OAuth2Error, requests.exceptions.RequestException) as e:
+                    sys.stderr.write("[WARN] Could not refresh expired token with scope '%s': %s\n" % (oauth_scope, e))
+
+            if token:
+                session = _oauth_session_for_token(config, oauth_scope, token)
+            elif interactive:
                 session, token = oauth_grant_to_token(config, oauth_scope)
                 oauth_save_token(config["MAJORA_TOKENS_FILE"], token)
             else:
@@ -118,29 +272,14 @@ def handle_oauth(config, oauth_scope, force_refresh=False, interactive=True):
                 return None, None
         else:
             try:
-                session = OAuth2Session(
-                        client_id=config["CLIENT_ID"],
-                        token=tokens[oauth_scope],
-                        scope=oauth_scope,
-                        auto_refresh_url=config["MAJORA_DOMAIN"]+"o/token/",
-                        auto_refresh_kwargs={
-                            "client_id": config["CLIENT_ID"],
-                            "client_secret": config["CLIENT_SECRET"],
-                        },
-                )
+                session = _oauth_session_for_token(config, oauth_scope, tokens[oauth_scope])
             except TokenUpdated as e:
-                oauth_save_token(config["MAJORA_TOKENS_FILE"], token)
-
-            if force_refresh:
-                #TODO This would actually force a double refresh in the case where the session is update automatically but whatever
-                refresh_params = {
-                    "client_id": config["CLIENT_ID"],
-                    "client_secret": config["CLIENT_SECRET"],
-                }
-                token = session.refresh_token(config["MAJORA_DOMAIN"]+"o/token/", **refresh_params)
-                oauth_save_token(config["MAJORA_TOKENS_FILE"], token)
+                oauth_save_token(config["MAJORA_TOKENS_FILE"], e.token)
 
             token = tokens[oauth_scope]
+            if force_refresh:
+                token = oauth_refresh_token(config, oauth_scope, token, force=True)
+                session = _oauth_session_for_token(config, oauth_scope, token)
     else:
         # No scoped token
         if interactive:
@@ -152,6 +291,110 @@ def handle_oauth(config, oauth_scope, force_refresh=False, interactive=True):
 
     return session, token
 
+# Sessions are kept per process by tokens file and scope, and only rebuilt when
+# the token is about to expire or the tokens file has been changed on disk
+OAUTH_EXPIRY_MARGIN = 60
+_oauth_cache = {}
+_oauth_cache_lock = threading.Lock()
+_oauth_scope_locks = {}
+
+def _get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+def get_oauth_session(config, oauth_scope, interactive=True):
+    tokens_path = config["MAJORA_TOKENS_FILE"]
+    cache_key = (tokens_path, oauth_scope)
+
+    with _oauth_cache_lock:
+        cached = _get_cached_oauth_session(cache_key, tokens_path)
+        if cached:
+            return cached
+        scope_lock = _oauth_scope_locks.setdefault(cache_key, threading.Lock())
+
+    # handle_oauth may refresh over the network or wait on a grant, so only hold
+    # the lock for this scope while it does, not the lock for the whole cache
+    with scope_lock:
+        with _oauth_cache_lock:
+            # Another thread may have just done the work while this one waited
+            cached = _get_cached_oauth_session(cache_key, tokens_path)
+            if cached:
+                return cached
+
+        session, token = handle_oauth(config, oauth_scope, interactive=interactive)
+        with _oauth_cache_lock:
+            if session and token:
+                # Stat after handle_oauth as it may have just written a new token
+                _oauth_cache[cache_key] = (session, token, _get_mtime(tokens_path))
+            else:
+                _oauth_cache.pop(cache_key, None)
+    return session, token
+
+def _get_cached_oauth_session(cache_key, tokens_path):
+    # Return the cached (session, token) if it is still good, holding _oauth_cache_lock
+    cached = _oauth_cache.get(cache_key)
+    if cached:
+        session, token, mtime = cached
+        if mtime == _get_mtime(tokens_path) and token.get("expires_at", 0) - OAUTH_EXPIRY_MARGIN > time.time():
+            return session, token
+    return None
+
+# Long running processes can keep their cached sessions fresh in the background
+# so that requests never have to wait on a refresh themselves
+_oauth_refresher = None
+
+def start_oauth_refresher(config):
+    global _oauth_refresher
+    with _oauth_cache_lock:
+        if not _oauth_refresher or not _oauth_refresher.is_alive():
+            margin = int(config.get("OCARINA_TOKEN_REFRESH_MARGIN", 300))
+            _oauth_refresher = threading.Thread(target=_oauth_refresh_loop, args=(config, margin), name="ocarina-oauth-refresher", daemon=True)
+            _oauth_refresher.start()
+    return _oauth_refresher
+
+def _oauth_refresh_at(token, margin):
+    # Refresh margin seconds before the token expires, but no earlier than
+    # halfway through its lifetime, so a margin as long as the lifetime does not
+    # leave every new token due for refresh as soon as it arrives
+    lifetime = token.get("expires_in")
+    if lifetime:
+        margin = min(margin, lifetime / 2)
+    return token.get("expires_at", 0) - margin
+
+def _oauth_refresh_loop(config, margin):
+    tokens_path = config["MAJORA_TOKENS_FILE"]
+    while True:
+        now = time.time()
+        next_wake = now + 60
+        with _oauth_cache_lock:
+            cached = [(k, v) for k, v in _oauth_cache.items() if k[0] == tokens_path]
+
+        for cache_key, (session, token, mtime) in cached:
+            refresh_at = _oauth_refresh_at(token, margin)
+            if refresh_at <= now:
+                if not token.get("refresh_token"):
+                    continue
+                try:
+                    token = oauth_refresh_token(config, cache_key[1], token)
+                    session = _oauth_session_for_token(config, cache_key[1], token)
+                except Exception as e:
+                    # Anything at all (eg. a bad tokens file or a scope change
+                    # warning), this thread must not die or nothing is refreshed
+                    sys.stderr.write("[WARN] Could not refresh token with scope '%s' in the background: %s\n" % (cache_key[1], e))
+                    continue
+                with _oauth_cache_lock:
+                    _oauth_cache[cache_key] = (session, token, _get_mtime(tokens_path))
+                refresh_at = _oauth_refresh_at(token, margin)
+                if refresh_at <= time.time():
+                    # Already due again, back off rather than asking for a new
+                    # token every second
+                    refresh_at = now + 60
+            next_wake = min(next_wake, refresh_at)
+
+        time.sleep(max(1, next_wake - time.time()))
+
 def oauth_grant_to_token(config, oauth_scope):
     #TODO Very particular about the URL here - need to mitigate risk of //
     oauth = OAuth2Session(client_id=config["CLIENT_ID"], redirect_uri=config["MAJORA_DOMAIN"]+"o/callback/", scope=oauth_scope)
@@ -171,7 +414,240 @@ def oauth_grant_to_token(config, oauth_scope):
     token = oauth.fetch_token(config["MAJORA_DOMAIN"]+"o/token/", authorization_response=authorization_response, client_secret=config["CLIENT_SECRET"])
     return oauth, token
 
-def emit(ocarina, endpoint, payload, quiet=False):
+_http_session_lock = threading.Lock()
+
+def get_http_session(ocarina):
+    # Build the pooled session once per Ocarina and hand the same one back for
+    # every emit, so requests to MAJORA_DOMAIN can reuse keep-alive connections
+    with _http_session_lock:
+        if not ocarina.http_session:
+            pool_size = max(1, int(ocarina.config.get("OCARINA_POOL_SIZE", 10)))
+            ocarina.http_adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            ocarina.http_session = requests.Session()
+            mount_http_adapter(ocarina, ocarina.http_session)
+    return ocarina.http_session
+
+def mount_http_adapter(ocarina, session):
+    # OAuth sessions are rebuilt by handle_oauth, but they can still share the
+    # connection pool as it lives on the adapter rather than the session
+    if not ocarina.http_adapter:
+        get_http_session(ocarina)
+    session.mount("https://", ocarina.http_adapter)
+    session.mount("http://", ocarina.http_adapter)
+    return session
+
+def get_rate_limiter(ocarina):
+    # OCARINA_RATE_LIMIT of 0 leaves requests unlimited
+    with _http_session_lock:
+        if not ocarina.rate_limiter:
+            rate = float(ocarina.config.get("OCARINA_RATE_LIMIT", 0))
+            if rate <= 0:
+                return None
+
+            state_path = None
+            if int(ocarina.config.get("OCARINA_RATE_SHARED", 0)) != 0:
+                # One bucket per user per Majora, shared by every process on this host
+                bucket_name = hashlib.md5((ocarina.config["MAJORA_DOMAIN"] + ocarina.config["MAJORA_USER"]).encode()).hexdigest()
+                state_path = os.path.join(tempfile.gettempdir(), "ocarina-ratelimit-%d-%s" % (os.getuid(), bucket_name))
+            ocarina.rate_limiter = TokenBucket(rate, int(ocarina.config.get("OCARINA_RATE_BURST", 0)), state_path=state_path)
+    return ocarina.rate_limiter
+
+def get_task_cache(ocarina):
+    # OCARINA_CACHE_TTL of 0 leaves task results uncached
+    with _http_session_lock:
+        if not ocarina.task_cache:
+            ttl = int(ocarina.config.get("OCARINA_CACHE_TTL", 0))
+            if ttl <= 0:
+                return None
+
+            cache_dir = ocarina.config.get("OCARINA_CACHE_DIR") or os.path.expanduser("~/.cache/ocarina/tasks")
+            max_bytes = int(ocarina.config.get("OCARINA_CACHE_SIZE", 1024)) * 1024 * 1024
+            namespace = "%s %s" % (ocarina.config["MAJORA_DOMAIN"], ocarina.config["MAJORA_USER"])
+            ocarina.task_cache = TaskCache(cache_dir, ttl, max_bytes, namespace=namespace)
+    return ocarina.task_cache
+
+def catch_exit(f, *args, **kwargs):
+    # emit will sys.exit on a bad response. Worker threads call through here so
+    # one bad request does not take the rest down with it, returning
+    # (exit_code, result, message) rather than raising
+    try:
+        ret = f(*args, **kwargs)
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else 70, None, str(e.code)
+    except Exception as e:
+        return 70, None, str(e) #EX_SOFTWARE
+    return 0, ret, ""
+
+def exit_message(code, message):
+    # Describe a failure returned by catch_exit, without repeating the exit code
+    # when that is all the SystemExit had to say
+    if not message or message == str(code):
+        return "exit code %d" % code
+    return "exit code %d: %s" % (code, message)
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def get_retry_wait(ocarina, attempt, retry_after=None):
+    # Exponential backoff with full jitter, capped at OCARINA_RETRY_MAX_WAIT
+    backoff = int(ocarina.config.get("OCARINA_RETRY_BACKOFF", 2))
+    max_wait = int(ocarina.config.get("OCARINA_RETRY_MAX_WAIT", 120))
+    wait = random.uniform(0, min(max_wait, backoff * (2 ** (attempt - 1))))
+
+    retry_after = parse_retry_after(retry_after)
+    if retry_after is not None:
+        if retry_after > max_wait:
+            # Majora wants us to go away for longer than we are prepared to wait
+            return None
+        wait = max(wait, retry_after)
+    return wait
+
+def task_poll_schedule(initial, ceiling, deadline):
+    # Yield how many seconds to sleep before each poll of a task, starting at
+    # initial and doubling up to ceiling, until deadline seconds have passed.
+    # The task is always polled at least once, even if the deadline is 0
+    start = time.time()
+    delay = max(0.1, initial)
+    first = True
+    while True:
+        remaining = deadline - (time.time() - start)
+        if remaining <= 0 and not first:
+            return
+        first = False
+        yield min(delay, max(remaining, 0))
+        delay = min(max(ceiling, initial), delay * 2)
+
+def encode_payload(ocarina, payload):
+    # Serialise the payload for a request body, gzipping it if it is larger than
+    # OCARINA_GZIP_THRESHOLD bytes (and the threshold is not 0).
+    # Returns the body, any headers to send with it and the number of bytes saved.
+    body = codec.dumps(payload)
+    headers = {
+        "Content-Type": "application/json",
+    }
+    threshold = int(ocarina.config.get("OCARINA_GZIP_THRESHOLD", 0))
+    if threshold > 0 and len(body) > threshold:
+        compressed = gzip.compress(body, compresslevel=6)
+        if len(compressed) < len(body):
+            headers["Content-Encoding"] = "gzip"
+            return compressed, headers, len(body) - len(compressed)
+    return body, headers, 0
+
+def _emit_request(ocarina, endpoint, request_type, oauth_scope, body, body_headers, params, user_agent, stream=False):
+    headers = {
+        "charset": "UTF-8",
+        "User-Agent": user_agent,
+        # requests will decompress responses for us, make sure Majora knows that
+        "Accept-Encoding": "gzip, deflate",
+    }
+    if not ocarina.oauth:
+        # Old school non-OAuth and v2 APIs POST here
+        headers.update(body_headers)
+        r = get_http_session(ocarina).post(ocarina.config["MAJORA_DOMAIN"] + endpoint + '/',
+                headers = headers,
+                data = body,
+                stream = stream,
+        )
+    else:
+        # OAuth and v3 endpoints drop to here
+        # Fetch the session from the cache, which will reload it from the tokens
+        # file if it has changed to ensure a token change does not disrupt polling tasks
+        oauth_session, oauth_token = get_oauth_session(ocarina.config, oauth_scope, interactive=ocarina.interactive)
+        ocarina.oauth_session, ocarina.oauth_token = oauth_session, oauth_token
+
+        if not oauth_session or not oauth_token:
+            # Looks like oauth failed, this should just trigger a 400
+            print("Unexpected OAuth Error. Try refreshing all tokens with `ocarina oauth refresh`.")
+            sys.exit(75) #EX_TEMPFAIL
+        mount_http_adapter(ocarina, oauth_session)
+
+        if request_type == "POST":
+            headers.update(body_headers)
+            r = oauth_session.post(ocarina.config["MAJORA_DOMAIN"] + endpoint + '/',
+                    headers = headers,
+                    data = body,
+                    stream = stream,
+            )
+        elif request_type == "GET":
+            r = oauth_session.get(ocarina.config["MAJORA_DOMAIN"] + endpoint + '/',
+                    headers = headers,
+                    params = params,
+                    stream = stream,
+            )
+    return r
+
+def _spool_response(r, threshold):
+    # Read the body into memory, or into a temporary file once it is bigger
+    # than threshold bytes, returning a binary file handle at the start of it
+    chunks = r.iter_content(chunk_size=jsonstream.CHUNK_SIZE)
+    parts = []
+    size = 0
+    for chunk in chunks:
+        parts.append(chunk)
+        size += len(chunk)
+        if size > threshold:
+            fh = tempfile.TemporaryFile()
+            for part in parts:
+                fh.write(part)
+            parts = None
+            for chunk in chunks:
+                fh.write(chunk)
+            fh.seek(0)
+            r.close()
+            return fh
+    r.close()
+    return io.BytesIO(b"".join(parts))
+
+def _decode_file(fh, streamed, iter_path):
+    # Decode a response body that has been saved to disk (or a BytesIO).
+    # Files are memory mapped so only the part being parsed needs to be read in.
+    if streamed:
+        try:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Not a real file, or an empty one
+            mm = None
+
+        if mm:
+            data = mm
+            def close():
+                mm.close()
+                fh.close()
+        else:
+            data = fh.read()
+            close = fh.close
+        chunks = lambda: (data[i:i+jsonstream.CHUNK_SIZE] for i in range(0, len(data), jsonstream.CHUNK_SIZE))
+        # The whole body is here, so scan past iter_path for anything that comes
+        # after it (eg. task) now rather than once the stream has been consumed
+        around = jsonstream.read_around(chunks(), iter_path, loads=codec.loads)
+        ret_json = jsonstream.stream_json(chunks(), iter_path, loads=codec.loads, close=close)
+        return jsonstream.merge_missing(ret_json, around)
+    with fh:
+        return codec.loads(fh.read())
+
+def emit(ocarina, endpoint, payload, quiet=False, iter_path=None, stream=None, cache_key=None):
+    # When streaming, iter_path names a value in the response (eg. get.result)
+    # that will be returned as a jsonstream.JsonPathStream to be iterated or copied
+    # out instead of being decoded in one go. Streaming follows --stream unless
+    # the stream argument says otherwise.
+    # With a cache_key (eg. a task ID) and OCARINA_CACHE_TTL set, a successful
+    # task response is kept on disk and returned again without a request.
+    # OCARINA_SPOOL_THRESHOLD also streams anything with an iter_path, but from a
+    # copy of the response in memory, or on disk if it is larger than the threshold
+    if stream is None:
+        stream = ocarina.stream
+    spool_threshold = int(ocarina.config.get("OCARINA_SPOOL_THRESHOLD", 0)) if iter_path else 0
+    streamed = bool(iter_path and (stream or spool_threshold > 0))
 
     params = payload.get("params")
     if params:
@@ -201,57 +677,76 @@ def emit(ocarina, endpoint, payload, quiet=False):
     payload["username"] = ocarina.config["MAJORA_USER"]
 
     request_type = "POST"
+    oauth_scope = ocarina.oauth_scope
+    original_endpoint = endpoint
     if type(endpoint) == dict:
         # OAuth and v3 endpoints are defined with a dict so we can catch them here
         if "scope" in endpoint:
-            ocarina.oauth_scope = endpoint["scope"] # store the last scope for polling tasks to access later
+            # keep hold of the scope locally as batch workers may share this ocarina
+            oauth_scope = endpoint["scope"]
+            ocarina.oauth_scope = oauth_scope # store the last scope for polling tasks to access later
             if not ocarina.oauth and endpoint["version"] in [0,3]:
                 sys.stderr.write("--oauth is required with experimental or v3 API endpoints")
                 sys.exit(64) #EX_USAGE
         request_type = endpoint["type"]
         endpoint = endpoint["endpoint"]
 
+    # 429 and 503 mean Majora turned the request away so it is always safe to
+    # try again, anything else is only retried when repeating it is harmless
+    retry_safe = request_type == "GET"
+    if type(original_endpoint) == dict:
+        retry_safe = original_endpoint.get("idempotent", retry_safe)
+    max_attempts = max(1, int(ocarina.config.get("OCARINA_RETRY_ATTEMPTS", 3)))
+
+    task_cache = get_task_cache(ocarina) if cache_key else None
+    if task_cache:
+        cached_fh = task_cache.get(endpoint, cache_key)
+        if cached_fh:
+            if not ocarina.quiet:
+                sys.stderr.write("[CACHE] Using the cached response for %s\n" % cache_key)
+            try:
+                ret_json = _decode_file(cached_fh, streamed, iter_path)
+            except:
+                sys.exit(69) #EX_UNAVAILABLE
+            if ret_json.get("errors", 0) > 0 and angry:
+                sys.exit(1) #EX_GENERAL
+            return ret_json
+
     if not ocarina.oauth:
-        # Old school non-OAuth and v2 APIs POST here
         payload["token"] = ocarina.config["MAJORA_TOKEN"]
-        r = requests.post(ocarina.config["MAJORA_DOMAIN"] + endpoint + '/',
-                headers = {
-                    "Content-Type": "application/json",
-                    "charset": "UTF-8",
-                    "User-Agent": "%s %s" % (payload["client_name"], payload["client_version"]),
-                },
-                json = payload,
-        )
     else:
-        # OAuth and v3 endpoints drop to here
-        # Always refresh the session to ensure a token change does not disrupt polling tasks
-        ocarina.oauth_session, ocarina.oauth_token = handle_oauth(ocarina.config, ocarina.oauth_scope, interactive=ocarina.interactive)
+        payload["token"] = "OAUTH"
 
-        if not ocarina.oauth_session or not ocarina.oauth_token:
-            # Looks like oauth failed, this should just trigger a 400
-            print("Unexpected OAuth Error. Try refreshing all tokens with `ocarina oauth refresh`.")
-            sys.exit(75) #EX_TEMPFAIL
+    # Encode the body once, rather than on every attempt
+    body, body_headers, bytes_saved = None, {}, 0
+    if request_type == "POST" or not ocarina.oauth:
+        body, body_headers, bytes_saved = encode_payload(ocarina, payload)
+    user_agent = "%s %s" % (payload["client_name"], payload["client_version"])
 
-        payload["token"] = "OAUTH"
-        if request_type == "POST":
-            r = ocarina.oauth_session.post(ocarina.config["MAJORA_DOMAIN"] + endpoint + '/',
-                    headers = {
-                        "Content-Type": "application/json",
-                        "charset": "UTF-8",
-                        "User-Agent": "%s %s" % (payload["client_name"], payload["client_version"]),
-                    },
-                    json = payload,
-                    stream = ocarina.stream,
-            )
-        elif request_type == "GET":
-            r = ocarina.oauth_session.get(ocarina.config["MAJORA_DOMAIN"] + endpoint + '/',
-                    headers = {
-                        "charset": "UTF-8",
-                        "User-Agent": "%s %s" % (payload["client_name"], payload["client_version"]),
-                    },
-                    params = params,
-                    stream = ocarina.stream,
-            )
+    attempt = 0
+    while True:
+        attempt += 1
+        rate_limiter = get_rate_limiter(ocarina)
+        if rate_limiter:
+            rate_limiter.acquire()
+        try:
+            r = _emit_request(ocarina, endpoint, request_type, oauth_scope, body, body_headers, params, user_agent, stream=stream or bool(task_cache) or spool_threshold > 0)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if not retry_safe or attempt >= max_attempts:
+                raise
+            wait = get_retry_wait(ocarina, attempt)
+            sys.stderr.write("[RETRY] %s (attempt %d of %d), trying again in %.1fs\n" % (e.__class__.__name__, attempt, max_attempts, wait))
+            time.sleep(wait)
+            continue
+
+        if attempt < max_attempts and (r.status_code in [429, 503] or (r.status_code == 500 and retry_safe)):
+            wait = get_retry_wait(ocarina, attempt, retry_after=r.headers.get("Retry-After"))
+            if wait is not None:
+                sys.stderr.write("[RETRY] STATUS CODE %d (attempt %d of %d), trying again in %.1fs\n" % (r.status_code, attempt, max_attempts, wait))
+                r.close()
+                time.sleep(wait)
+                continue
+        break
 
     if r.status_code != 200:
         sys.stderr.write("Request" + "="*(80-len("Request ")) + '\n')
@@ -274,25 +769,54 @@ def emit(ocarina, endpoint, payload, quiet=False):
             # Otherwise assume we fucked it and issue general 70
             sys.exit(70) #EX_SOFTWARE
 
+    # Decode the response exactly once, everything below shares ret_json
+    cache_writer = None
+    try:
+        if task_cache:
+            # Save the body to the cache as it arrives, and read it back from there
+            cache_writer = task_cache.writer(endpoint, cache_key)
+            for chunk in r.iter_content(chunk_size=jsonstream.CHUNK_SIZE):
+                cache_writer.write(chunk)
+            r.close()
+            ret_json = _decode_file(cache_writer.open(), streamed, iter_path)
+        elif spool_threshold > 0:
+            ret_json = _decode_file(_spool_response(r, spool_threshold), streamed, iter_path)
+        elif streamed:
+            # Leave the container at iter_path on the wire to be consumed lazily
+            ret_json = jsonstream.stream_json(r.iter_content(chunk_size=jsonstream.CHUNK_SIZE), iter_path, loads=codec.loads, close=r.close)
+        else:
+            ret_json = codec.loads(r.content)
+    except:
+        if cache_writer:
+            cache_writer.abort()
+        sys.exit(69) #EX_UNAVAILABLE
+
+    if cache_writer:
+        # Only keep results of tasks that have finished
+        if ret_json.get("task", {}).get("state") == "SUCCESS":
+            cache_writer.commit()
+        else:
+            cache_writer.abort()
+
     if not quiet:
         sys.stderr.write("Request" + "="*(80-len("Request ")) + '\n')
         payload["token"] = '*'*len(payload["token"])
         sys.stderr.write(json.dumps(payload, indent=4, sort_keys=True))
+        if bytes_saved:
+            sys.stderr.write("\nRequest body gzipped to %d bytes, saving %d bytes" % (len(body), bytes_saved))
 
         sys.stderr.write("\nResponse" + "="*(80-len("Request ")) + '\n')
-        sys.stderr.write(json.dumps(r.json(), indent=4, sort_keys=True) + '\n')
-
-    try:
-        ret_json = r.json()
-    except:
-        sys.exit(69) #EX_UNAVAILABLE
+        if streamed:
+            sys.stderr.write("Response will be streamed\n")
+        else:
+            sys.stderr.write(json.dumps(ret_json, indent=4, sort_keys=True) + '\n')
 
-    if ret_json["errors"] > 0 and angry:
+    if ret_json.get("errors", 0) > 0 and angry:
         sys.exit(1) #EX_GENERAL
 
-    return r.json()
+    return ret_json
 
-def hashfile(path, start_clock=None, halg=hashlib.md5, bs=65536, force_hash=False, partial_limit=10737418240, partial_sample=0.2):
+def hashfile(path, start_clock=None, halg=hashlib.md5, bs=HASH_BLOCK_SIZE, force_hash=False, partial_limit=HASH_PARTIAL_LIMIT, partial_sample=0.2, use_mmap=False):
     start_time = datetime.now()
 
     hashed=False
@@ -306,68 +830,91 @@ def hashfile(path, start_clock=None, halg=hashlib.md5, bs=65536, force_hash=Fals
     #    # The file /probably/ hasn't change, so don't bother rehashing...
     #    ret = 'U'
 
+    hashes, b_hashed = _hash_file(path, [halg()], bs, partial_limit, partial_sample, use_mmap)
+    hashed=True
+
+    ret = '0'
+    if hashed:
+        ret = hashes[0].hexdigest()
+
+    end_time = datetime.now()
+    hash_time = end_time - start_time
+    #syslog.syslog('Hashed %s (~%.2fGB of %.2fGB in %s)' % (path, float(b_hashed) / 1e+9, float(os.path.getsize(path)) / 1e+9, str(hash_time)))
+
+    return ret
+
+def hashfile_digests(path, algorithms, bs=HASH_BLOCK_SIZE, use_mmap=False):
+    # Return a dict of the hex digest of the whole file for each hashlib
+    # algorithm name, reading the file once however many there are. Unlike
+    # hashfile, large files are never sampled.
+    hashes, b_hashed = _hash_file(path, [hashlib.new(name) for name in algorithms], bs, os.path.getsize(path), 0, use_mmap)
+    return {name: h.hexdigest() for name, h in zip(algorithms, hashes)}
+
+def _hash_file(path, hashes, bs, partial_limit, partial_sample, use_mmap):
+    # Feed path to every hash in hashes in one pass, through one reused buffer of
+    # bs bytes (or a memory map of the whole file). Returns the hashes and the
+    # number of bytes hashed.
+    size = os.path.getsize(path)
+    if not bs or bs < 1:
+        # A block size of 0 would read nothing and hash the file as empty
+        bs = HASH_BLOCK_SIZE
+    buf = bytearray(bs)
+    view = memoryview(buf)
+
+    def update(chunk):
+        for h in hashes:
+            h.update(chunk)
+
+    def read_into(f, limit=None):
+        # Hash up to limit bytes (or to the end of the file) from where f is
+        n_read = 0
+        while limit is None or n_read < limit:
+            n = f.readinto(view if limit is None else view[:min(bs, limit - n_read)])
+            if not n:
+                break
+            update(view[:n])
+            n_read += n
+        return n_read
+
     # For files less than partial_limit, just get on with it
-    b_hashed = 0
-    if os.path.getsize(path) <= partial_limit:
-        f = open(path, 'rb')
-        buff = f.read(bs)
-        halg = halg()
-        halg.update(buff)
-        b_hashed = bs
-        while len(buff) > 0:
-            buff = f.read(bs)
-            halg.update(buff)
-            b_hashed += bs
-        f.close()
-        hashed=True
-    else:
+    with open(path, 'rb') as f:
+        if size <= partial_limit:
+            if use_mmap and size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    mm_view = memoryview(mm)
+                    for start in range(0, size, bs):
+                        update(mm_view[start:start+bs])
+                    mm_view.release()
+                return hashes, size
+            return hashes, read_into(f)
+
         # I want to ensure no hashing process takes longer than 5 minutes
         # Caveat: The longer the file is, the more sparse the samples are
         # NOTE This is probably a fucking terrible idea
 
         # Assuming a total of partial_sample bytes to sample for the hash,
-        # find the skip size needed to evenly sample the file with bs blocks
+        # find the skip size needed to evenly sample the file with blocks of
+        # PARTIAL_BLOCK_SIZE, which stays the same whatever bs is so that the
+        # same bytes are sampled (and the same hash made) as always
         body_sample_size = 5.243e+8 # 500MiB
         ends_sample_size = 2.147e+9 # 2GiB
-        body_consec_samples = math.ceil(body_sample_size/bs)
-        ends_consec_samples = math.ceil(ends_sample_size/bs)
+        body_consec_bytes = math.ceil(body_sample_size/PARTIAL_BLOCK_SIZE) * PARTIAL_BLOCK_SIZE
+        ends_consec_bytes = math.ceil(ends_sample_size/PARTIAL_BLOCK_SIZE) * PARTIAL_BLOCK_SIZE
 
-        file_size_body = int(os.path.getsize(path) - ((2*ends_sample_size) + (2*body_sample_size)))
+        file_size_body = int(size - ((2*ends_sample_size) + (2*body_sample_size)))
         body_num_samples = int( (file_size_body * partial_sample) / body_sample_size) # number of body samples needed
         body_seek_size = int(file_size_body / body_num_samples)
 
         # Read the first blocks
-        f = open(path, 'rb')
-        halg = halg()
-        for i in range(ends_consec_samples):
-            buff = f.read(bs)
-            halg.update(buff)
-            b_hashed += bs
+        b_hashed = read_into(f, ends_consec_bytes)
 
         # Now seek to the evenly distributed sample points across the body
         pos = f.tell() + body_sample_size
         for i in range(body_num_samples):
             f.seek(int(pos))
-            for i in range(body_consec_samples):
-                buff = f.read(bs)
-                halg.update(buff)
-                b_hashed += bs
+            b_hashed += read_into(f, body_consec_bytes)
             pos = f.tell() + body_seek_size
 
-        f.seek(int(os.path.getsize(path) - ends_sample_size))
-        while len(buff) > 0:
-            buff = f.read(bs)
-            halg.update(buff)
-            b_hashed += bs
-        f.close()
-        hashed=True
-
-    ret = '0'
-    if hashed:
-        ret = halg.hexdigest()
-
-    end_time = datetime.now()
-    hash_time = end_time - start_time
-    #syslog.syslog('Hashed %s (~%.2fGB of %.2fGB in %s)' % (path, float(b_hashed) / 1e+9, float(os.path.getsize(path)) / 1e+9, str(hash_time)))
-
-    return ret
+        f.seek(int(size - ends_sample_size))
+        b_hashed += read_into(f)
+    return hashes, b_hashed
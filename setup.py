@@ -14,9 +14,15 @@ requirements = [
 ]
 
 test_requirements = [
-
+    "pytest",
 ]
 
+extra_requirements = {
+    "fast": ["orjson"],
+    "arrow": ["pyarrow"],
+    "zstd": ["zstandard"],
+}
+
 setuptools.setup(
     name="ocarina",
     version=version.__version__,
@@ -33,6 +39,7 @@ setuptools.setup(
 
     packages=setuptools.find_packages(),
     install_requires=requirements,
+    extras_require=extra_requirements,
 
     entry_points = {
         'console_scripts': [
@@ -0,0 +1,12 @@
+from ocarina import util
+
+def test_task_poll_schedule_zero_deadline_polls_once():
+    assert list(util.task_poll_schedule(2, 60, 0)) == [0]
+
+def test_task_poll_schedule_elapsed_deadline_polls_once():
+    assert list(util.task_poll_schedule(2, 60, -30)) == [0]
+
+def test_task_poll_schedule_backs_off_to_ceiling(monkeypatch):
+    monkeypatch.setattr(util.time, "time", lambda: 0)
+    schedule = util.task_poll_schedule(2, 10, 60)
+    assert [next(schedule) for _ in range(5)] == [2, 4, 8, 10, 10]